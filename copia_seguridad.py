@@ -0,0 +1,275 @@
+"""
+Copia de seguridad incremental de las carpetas de versiones (versions/ y versions_b/).
+
+Replica ambas carpetas en otra ruta local o volumen montado copiando sólo los
+archivos nuevos o cuyo contenido ha cambiado (SHA-256), y mantiene en el destino
+un manifiesto (manifiesto.json) con el hash, tamaño y fecha de cada archivo para
+poder verificar la copia y restaurarla.
+
+Los archivos borrados en origen NO se borran de la copia: así un "Eliminar todas
+las versiones" no arrastra la copia de seguridad.
+
+Uso desde la línea de comandos (p. ej. en una tarea programada diaria):
+    python copia_seguridad.py copia      /ruta/destino
+    python copia_seguridad.py verificar  /ruta/destino
+    python copia_seguridad.py restaurar  /ruta/destino
+Si no se indica destino se usa la variable de entorno STOCK_BACKUP_DIR.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+CARPETAS = ("versions", "versions_b")
+MANIFIESTO = "manifiesto.json"
+TAM_BLOQUE = 1024 * 1024
+
+# Evita que dos sesiones del mismo servidor escriban el manifiesto a la vez
+_lock = threading.Lock()
+
+
+def destino_por_defecto() -> str:
+    return os.environ.get("STOCK_BACKUP_DIR", "")
+
+
+def hash_archivo(ruta: str) -> str:
+    """SHA-256 del contenido del archivo, leído por bloques."""
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(TAM_BLOQUE), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def _copiar_con_hash(origen: str, destino: str) -> str:
+    """
+    Copia 'origen' en 'destino' a través de un temporal (el destino nunca queda a
+    medias), conserva la fecha de modificación y devuelve el SHA-256 de lo copiado.
+    """
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporal = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+    h = hashlib.sha256()
+    try:
+        with open(origen, "rb") as f_in, open(temporal, "wb") as f_out:
+            for bloque in iter(lambda: f_in.read(TAM_BLOQUE), b""):
+                h.update(bloque)
+                f_out.write(bloque)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        st_origen = os.stat(origen)
+        os.utime(temporal, ns=(st_origen.st_atime_ns, st_origen.st_mtime_ns))
+        os.replace(temporal, destino)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return h.hexdigest()
+
+
+def _archivos(base: str, carpetas=CARPETAS):
+    """Rutas relativas (con '/') de todos los archivos de las carpetas indicadas."""
+    for carpeta in carpetas:
+        raiz = os.path.join(base, carpeta)
+        for subdir, _dirs, files in os.walk(raiz):
+            for nombre in files:
+                if nombre.endswith(".tmp"):
+                    continue
+                ruta = os.path.join(subdir, nombre)
+                yield os.path.relpath(ruta, base).replace(os.sep, "/")
+
+
+def ruta_segura(base: str, rel: str, carpetas=CARPETAS):
+    """
+    Ruta absoluta de 'rel' dentro de base/<carpeta>, o None si la entrada del
+    manifiesto no es una ruta relativa limpia bajo una de las carpetas copiadas
+    (p. ej. 'versions/../../x' o una ruta absoluta).
+    """
+    if not isinstance(rel, str) or not rel or os.path.isabs(rel) or "\\" in rel:
+        return None
+    partes = rel.split("/")
+    if partes[0] not in carpetas or len(partes) < 2 or any(p in ("", ".", "..") for p in partes):
+        return None
+    raiz = os.path.realpath(os.path.join(base, partes[0]))
+    ruta = os.path.realpath(os.path.join(base, *partes))
+    if os.path.commonpath([raiz, ruta]) != raiz or ruta == raiz:
+        return None
+    return ruta
+
+
+def cargar_manifiesto(destino: str) -> dict:
+    ruta = os.path.join(destino, MANIFIESTO)
+    if not os.path.exists(ruta):
+        return {"archivos": {}}
+    with open(ruta, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _escribir_manifiesto(destino: str, manifiesto: dict):
+    ruta = os.path.join(destino, MANIFIESTO)
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(manifiesto, f, ensure_ascii=False, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+
+
+def hacer_copia(destino: str, origen: str = ".", carpetas=CARPETAS) -> dict:
+    """
+    Copia incremental de 'carpetas' (relativas a 'origen') en 'destino'.
+
+    Un archivo cuyo tamaño y fecha de modificación coinciden con el manifiesto se
+    da por copiado sin leerlo; si cambian, se calcula su hash y sólo se copia si el
+    contenido es distinto (o falta en el destino). Así el tiempo de la copia depende
+    de lo modificado desde la última copia y no del tamaño del archivo histórico.
+    """
+    if not destino:
+        raise ValueError("No se ha indicado la ruta de destino de la copia de seguridad.")
+    if os.path.abspath(destino) == os.path.abspath(origen):
+        raise ValueError("El destino de la copia no puede ser la carpeta de la aplicación.")
+
+    inicio = time.perf_counter()
+    resumen = {"copiados": 0, "sin_cambios": 0, "solo_en_copia": 0, "bytes_copiados": 0}
+    with _lock:
+        os.makedirs(destino, exist_ok=True)
+        manifiesto = cargar_manifiesto(destino)
+        entradas = manifiesto.setdefault("archivos", {})
+        vistos = set()
+
+        for rel in _archivos(origen, carpetas):
+            vistos.add(rel)
+            ruta_origen = os.path.join(origen, rel)
+            ruta_destino = os.path.join(destino, rel)
+            st_origen = os.stat(ruta_origen)
+            entrada = entradas.get(rel)
+            existe_destino = os.path.exists(ruta_destino)
+
+            if (entrada and existe_destino
+                    and entrada["tamano"] == st_origen.st_size
+                    and entrada["mtime_ns"] == st_origen.st_mtime_ns):
+                resumen["sin_cambios"] += 1
+                continue
+
+            if entrada and existe_destino and hash_archivo(ruta_origen) == entrada["sha256"]:
+                # Mismo contenido con otra fecha: sólo se actualiza el manifiesto
+                entrada["mtime_ns"] = st_origen.st_mtime_ns
+                resumen["sin_cambios"] += 1
+                continue
+
+            sha = _copiar_con_hash(ruta_origen, ruta_destino)
+            entradas[rel] = {
+                "sha256": sha,
+                "tamano": st_origen.st_size,
+                "mtime_ns": st_origen.st_mtime_ns,
+                "copiado": datetime.datetime.now().isoformat(timespec="seconds"),
+            }
+            resumen["copiados"] += 1
+            resumen["bytes_copiados"] += st_origen.st_size
+
+        resumen["solo_en_copia"] = sum(
+            1 for rel in entradas if rel.split("/", 1)[0] in carpetas and rel not in vistos
+        )
+        manifiesto["actualizado"] = datetime.datetime.now().isoformat(timespec="seconds")
+        _escribir_manifiesto(destino, manifiesto)
+
+    resumen["total"] = len(vistos)
+    resumen["segundos"] = round(time.perf_counter() - inicio, 3)
+    return resumen
+
+
+def verificar_copia(destino: str) -> list:
+    """
+    Recalcula el hash de cada archivo de la copia y lo compara con el manifiesto.
+    Devuelve la lista de problemas [(ruta relativa, motivo)]; vacía si todo cuadra.
+    """
+    problemas = []
+    entradas = cargar_manifiesto(destino).get("archivos", {})
+    for rel, entrada in sorted(entradas.items()):
+        ruta = ruta_segura(destino, rel)
+        if ruta is None:
+            problemas.append((rel, "ruta no válida en el manifiesto"))
+        elif not os.path.exists(ruta):
+            problemas.append((rel, "falta en la copia"))
+        elif os.path.getsize(ruta) != entrada["tamano"]:
+            problemas.append((rel, "tamaño distinto"))
+        elif hash_archivo(ruta) != entrada["sha256"]:
+            problemas.append((rel, "hash distinto"))
+    return problemas
+
+
+def restaurar_copia(destino: str, origen: str = ".", carpetas=CARPETAS) -> dict:
+    """
+    Restaura en 'origen' los archivos de la copia que falten o difieran.
+
+    Los archivos se restauran en el orden de su fecha original (que además se
+    conserva), de modo que la versión más reciente sigue siendo la misma. Cada
+    archivo restaurado se comprueba contra el hash del manifiesto.
+    """
+    inicio = time.perf_counter()
+    resumen = {"restaurados": 0, "sin_cambios": 0, "errores": []}
+    entradas = cargar_manifiesto(destino).get("archivos", {})
+    pendientes = sorted(
+        (e["mtime_ns"], rel) for rel, e in entradas.items() if rel.split("/", 1)[0] in carpetas
+    )
+    for _mtime, rel in pendientes:
+        entrada = entradas[rel]
+        # Nunca se escribe fuera de origen/<carpeta> ni se lee fuera de destino/<carpeta>
+        ruta_copia = ruta_segura(destino, rel, carpetas)
+        ruta_origen = ruta_segura(origen, rel, carpetas)
+        if ruta_copia is None or ruta_origen is None:
+            resumen["errores"].append((rel, "ruta no válida en el manifiesto"))
+            continue
+        if os.path.exists(ruta_origen):
+            st_origen = os.stat(ruta_origen)
+            # Mismo tamaño y fecha que al copiarlo: se da por intacto sin leerlo
+            if st_origen.st_size == entrada["tamano"] and (
+                st_origen.st_mtime_ns == entrada["mtime_ns"]
+                or hash_archivo(ruta_origen) == entrada["sha256"]
+            ):
+                resumen["sin_cambios"] += 1
+                continue
+        if not os.path.exists(ruta_copia):
+            resumen["errores"].append((rel, "falta en la copia"))
+            continue
+        if _copiar_con_hash(ruta_copia, ruta_origen) != entrada["sha256"]:
+            resumen["errores"].append((rel, "hash distinto tras restaurar"))
+            continue
+        resumen["restaurados"] += 1
+    resumen["segundos"] = round(time.perf_counter() - inicio, 3)
+    return resumen
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copia de seguridad incremental de versions/ y versions_b/.")
+    parser.add_argument("accion", choices=["copia", "verificar", "restaurar"])
+    parser.add_argument("destino", nargs="?", default=destino_por_defecto(),
+                        help="Ruta de la copia (por defecto $STOCK_BACKUP_DIR)")
+    parser.add_argument("--origen", default=".", help="Carpeta de la aplicación (por defecto la actual)")
+    args = parser.parse_args(argv)
+    if not args.destino:
+        parser.error("indique el destino o defina STOCK_BACKUP_DIR")
+
+    if args.accion == "copia":
+        r = hacer_copia(args.destino, args.origen)
+        print(f"Copiados: {r['copiados']} ({r['bytes_copiados'] / 1024 ** 2:.1f} MB), "
+              f"sin cambios: {r['sin_cambios']}, sólo en la copia: {r['solo_en_copia']} "
+              f"({r['segundos']} s)")
+        return 0
+    if args.accion == "verificar":
+        problemas = verificar_copia(args.destino)
+        for rel, motivo in problemas:
+            print(f"{rel}: {motivo}")
+        print("Copia verificada correctamente." if not problemas else f"{len(problemas)} problema(s).")
+        return 1 if problemas else 0
+    r = restaurar_copia(args.destino, args.origen)
+    for rel, motivo in r["errores"]:
+        print(f"{rel}: {motivo}")
+    print(f"Restaurados: {r['restaurados']}, sin cambios: {r['sin_cambios']} ({r['segundos']} s)")
+    return 1 if r["errores"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
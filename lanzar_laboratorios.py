@@ -0,0 +1,117 @@
+"""
+Lanzador de varios procesos (workers) de la aplicación, uno por puerto.
+
+Cada worker es un `streamlit run streamlit_app.py` independiente (su propio
+proceso y núcleo) con la variable STOCK_LAB fijada a su laboratorio, de modo que
+su caché global y sus carpetas de versiones son las de esa partición. Varios
+workers pueden servir el mismo laboratorio: los guardados se serializan con un
+bloqueo de archivo por partición, cada worker detecta los cambios de los demás y
+un guardado hecho sobre datos que otro ya ha modificado se rechaza.
+
+Uso:
+    python lanzar_laboratorios.py --worker principal --worker lab_norte --worker lab_norte
+    python lanzar_laboratorios.py --worker lab_sur:8601 --puerto-inicial 8501
+
+Si varios workers del mismo laboratorio se ponen detrás de un proxy, éste debe
+mantener cada sesión en el mismo worker (sesiones "pegajosas"): el estado de una
+sesión de Streamlit vive en el proceso que la atiende.
+"""
+import argparse
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+
+
+def leer_workers(especificaciones, puerto_inicial: int) -> list:
+    """'lab[:puerto]' -> [(lab, puerto)], asignando puertos libres a partir de puerto_inicial."""
+    workers, usados = [], set()
+    for espec in especificaciones:
+        lab, _, puerto = espec.partition(":")
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", lab):
+            raise ValueError(f"Nombre de laboratorio no válido: '{lab}'")
+        workers.append([lab, int(puerto) if puerto else None])
+        if puerto:
+            usados.add(int(puerto))
+    siguiente = puerto_inicial
+    for w in workers:
+        if w[1] is None:
+            while siguiente in usados:
+                siguiente += 1
+            w[1] = siguiente
+            usados.add(siguiente)
+    if len(usados) != len(workers):
+        raise ValueError("Hay puertos repetidos entre los workers.")
+    return [tuple(w) for w in workers]
+
+
+def lanzar(lab: str, puerto: int, raiz_datos: str, extra: list) -> subprocess.Popen:
+    entorno = dict(os.environ, STOCK_LAB=lab)
+    if raiz_datos:
+        entorno["STOCK_DATA_ROOT"] = raiz_datos
+    comando = [
+        sys.executable, "-m", "streamlit", "run", RUTA_APP,
+        "--server.port", str(puerto), "--server.headless", "true",
+    ] + extra
+    return subprocess.Popen(comando, env=entorno)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lanza varios workers de la aplicación, uno por laboratorio/puerto.")
+    parser.add_argument("--worker", action="append", required=True, metavar="LAB[:PUERTO]",
+                        help="Laboratorio (y puerto opcional) de un worker; repetir para lanzar varios")
+    parser.add_argument("--puerto-inicial", type=int, default=8501, help="Primer puerto a asignar (por defecto 8501)")
+    parser.add_argument("--raiz-datos", default="", help="Carpeta raíz de los datos (STOCK_DATA_ROOT)")
+    parser.add_argument("--reiniciar", action="store_true", help="Relanzar un worker si termina inesperadamente")
+    args, extra = parser.parse_known_args(argv)
+
+    try:
+        workers = leer_workers(args.worker, args.puerto_inicial)
+    except ValueError as e:
+        parser.error(str(e))
+
+    procesos = {}
+    for lab, puerto in workers:
+        procesos[(lab, puerto)] = lanzar(lab, puerto, args.raiz_datos, extra)
+        print(f"Worker '{lab}' en http://localhost:{puerto} (pid {procesos[(lab, puerto)].pid})")
+
+    detener = False
+
+    def _parar(_signum, _frame):
+        nonlocal detener
+        detener = True
+
+    signal.signal(signal.SIGINT, _parar)
+    signal.signal(signal.SIGTERM, _parar)
+
+    codigo = 0
+    try:
+        while not detener and procesos:
+            time.sleep(1)
+            for (lab, puerto), proc in list(procesos.items()):
+                if proc.poll() is None:
+                    continue
+                print(f"El worker '{lab}' (puerto {puerto}) terminó con código {proc.returncode}.")
+                if args.reiniciar:
+                    procesos[(lab, puerto)] = lanzar(lab, puerto, args.raiz_datos, extra)
+                else:
+                    codigo = codigo or proc.returncode
+                    del procesos[(lab, puerto)]
+    finally:
+        for proc in procesos.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procesos.values():
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return codigo
+
+
+if __name__ == "__main__":
+    sys.exit(main())
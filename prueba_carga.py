@@ -0,0 +1,313 @@
+"""
+Prueba de carga de la aplicación de Control de Stock.
+
+Ejecuta el script real (streamlit_app.py) con la API de pruebas de Streamlit
+(streamlit.testing.v1.AppTest) simulando N sesiones concurrentes sobre datos
+sintéticos, y mide:
+
+- Latencia de cada rerun (p50 / p95), global y por acción.
+- Rendimiento de guardado (versiones de A escritas por segundo) y guardados
+  rechazados por datos desfasados (otra sesión guardó antes).
+- Memoria residente (RSS) del proceso y estimación por sesión.
+
+Uso:
+    python prueba_carga.py --sesiones 8 --iteraciones 5 --filas 500 --filas-b 5000
+
+El login se simula marcando la sesión como autenticada (igual que tras un
+login correcto con streamlit-authenticator). Por defecto se anulan las pausas
+time.sleep() que hace la app tras guardar, para medir sólo el cálculo; use
+--con-esperas para incluirlas.
+"""
+import argparse
+import ast
+import datetime
+import glob
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+PANELES = ["FOCUS", "OCA", "OCA PLUS"]
+PRODUCTOS = [
+    "Primers DNA", "Primers RNA", "Reagents DL8", "Chef supplies (plásticos)", "Placas", "Solutions DL8",
+    "Chef Reagents", "Chef Solutions", "Solutions Reagent S5", "Botellas S5", "H2O RNA free", "Tubos fondo cónico",
+]
+REFS_LIMITANTES = ["A42006", "A42007", "A27762", "A34018", "A33638", "A33639"]
+# Inicio del aviso de la app cuando rechaza un guardado hecho sobre datos desfasados
+AVISO_RECHAZO = "Otro usuario ha guardado"
+
+
+# ---------------------------------------------------------------------------------
+# Datos sintéticos
+# ---------------------------------------------------------------------------------
+def hoja_sintetica(panel: str, n_filas: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Hoja A con la misma estructura de columnas que la base real."""
+    refs = REFS_LIMITANTES + [f"A{50000 + i}" for i in range(max(1, n_filas // 3))]
+    sufijo = panel.replace(" ", "")
+    hoy = pd.Timestamp(datetime.date.today())
+    return pd.DataFrame({
+        "Ref. Saturno": 1000 + np.arange(n_filas) // 4,
+        "Ref. Fisher": rng.choice(refs, n_filas),
+        "Nombre producto": [f"{PRODUCTOS[i % len(PRODUCTOS)]} {i}" for i in range(n_filas)],
+        "Tª": rng.choice(["-20ºC", "2-8ºC", "Tª ambiente"], n_filas),
+        "Uds.": rng.integers(1, 6, n_filas),
+        "NºLote": [f"L{sufijo}{i}" for i in range(n_filas)],
+        "Caducidad": hoy + pd.to_timedelta(rng.integers(-30, 365, n_filas), unit="D"),
+        "Fecha Pedida": pd.NaT,
+        "Fecha Llegada": hoy - pd.to_timedelta(rng.integers(1, 90, n_filas), unit="D"),
+        "Sitio almacenaje": rng.choice(["Congelador 1", "Congelador 2", "Nevera 1", "Armario"], n_filas),
+        "Stock": rng.integers(0, 10, n_filas),
+    })
+
+
+def generar_datos(directorio: str, n_filas: int, n_filas_b: int, semilla: int):
+    """Escribe una versión A y una versión B sintéticas en 'directorio'."""
+    rng = np.random.default_rng(semilla)
+    subcarpeta = datetime.date.today().strftime("%Y_%m_%B")
+    ruta_a = os.path.join(directorio, "versions", subcarpeta)
+    ruta_b = os.path.join(directorio, "versions_b", subcarpeta)
+    os.makedirs(ruta_a, exist_ok=True)
+    os.makedirs(ruta_b, exist_ok=True)
+
+    with pd.ExcelWriter(os.path.join(ruta_a, "StockA_sintetico.xlsx"), engine="openpyxl") as writer:
+        for panel in PANELES:
+            hoja_sintetica(panel, n_filas, rng).to_excel(writer, sheet_name=panel, index=False)
+
+    with pd.ExcelWriter(os.path.join(ruta_b, "StockB_sintetico.xlsx"), engine="openpyxl") as writer_b:
+        for panel in PANELES:
+            hoja_b = hoja_sintetica(panel, n_filas_b, rng)
+            inicio = pd.Timestamp(datetime.date.today()) - pd.Timedelta(days=730)
+            hoja_b["Fecha Registro B"] = inicio + pd.to_timedelta(
+                np.sort(rng.integers(0, 730 * 24 * 60, n_filas_b)), unit="min"
+            )
+            hoja_b["Usuario"] = rng.choice(["user1", "user2"], n_filas_b)
+            hoja_b.to_excel(writer_b, sheet_name=panel, index=False)
+
+
+# ---------------------------------------------------------------------------------
+# Medición
+# ---------------------------------------------------------------------------------
+def rss_actual_mb():
+    """Memoria residente del proceso en MB (None si no se puede medir en este sistema)."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def contar_versiones_a() -> int:
+    """Versiones de A guardadas desde la app en el directorio actual."""
+    return len(glob.glob(os.path.join("versions", "*", "StockA_*.xlsx")))
+
+
+def parse_serializado(parse):
+    """
+    ast.parse protegido con un lock: en CPython 3.11 varios hilos analizando a la vez
+    pueden fallar con "AST constructor recursion depth mismatch", y AppTest analiza el
+    script en cada rerun. Sin esto, la sesión afectada se queda sin widgets.
+    """
+    lock = threading.Lock()
+
+    def _parse(*args, **kwargs):
+        with lock:
+            return parse(*args, **kwargs)
+    return _parse
+
+
+class Metricas:
+    """Acumula las latencias de rerun de todas las sesiones (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = []   # (acción, segundos)
+        self.errores = []     # (sesión, acción, mensaje)
+        self.intentos = 0     # clics en un botón de guardar
+        self.rechazos = 0     # guardados rechazados por datos desfasados
+        self.guardados = 0    # versiones de A escritas (se cuentan al final en disco)
+
+    def registrar(self, accion: str, segundos: float, rechazado: bool = False):
+        with self._lock:
+            self.latencias.append((accion, segundos))
+            if accion.startswith("guardar"):
+                self.intentos += 1
+                self.rechazos += rechazado
+
+    def error(self, sesion: int, accion: str, mensaje: str):
+        with self._lock:
+            self.errores.append((sesion, accion, mensaje))
+
+
+def ejecutar(at: AppTest, metricas: Metricas, sesion: int, accion: str):
+    """Ejecuta un rerun cronometrado y registra las excepciones que muestre la app."""
+    inicio = time.perf_counter()
+    at.run()
+    rechazado = any(e.value.startswith(AVISO_RECHAZO) for e in at.error)
+    metricas.registrar(accion, time.perf_counter() - inicio, rechazado)
+    for exc in at.exception:
+        metricas.error(sesion, accion, exc.value)
+
+
+def boton(at: AppTest, etiqueta: str):
+    for b in at.button:
+        if b.label == etiqueta:
+            return b
+    return None
+
+
+# ---------------------------------------------------------------------------------
+# Flujo de una sesión
+# ---------------------------------------------------------------------------------
+def simular_sesion(sesion: int, iteraciones: int, metricas: Metricas, semilla: int, timeout: float):
+    rng = random.Random(semilla + sesion)
+    at = AppTest.from_file(RUTA_APP, default_timeout=timeout)
+
+    # Login (sesión ya autenticada) y primera carga de A y B
+    at.session_state["authentication_status"] = True
+    at.session_state["name"] = f"Sesión {sesion}"
+    at.session_state["username"] = f"carga{sesion}"
+    ejecutar(at, metricas, sesion, "login")
+    if at.exception:
+        return
+
+    for _ in range(iteraciones):
+        # Seleccionar panel
+        at.selectbox(key="main_sheet_sel").set_value(rng.choice(PANELES))
+        ejecutar(at, metricas, sesion, "seleccionar_panel")
+
+        # Editar y guardar (cambio de lote => suma Uds. al stock y registra en B)
+        opciones = at.selectbox(key="react_modif").options
+        at.selectbox(key="react_modif").set_value(rng.choice(opciones))
+        ejecutar(at, metricas, sesion, "seleccionar_reactivo")
+        lote = next((t for t in at.text_input if t.label == "Nº de Lote"), None)
+        if lote is not None:
+            lote.set_value(f"LC{sesion}-{rng.randint(0, 10 ** 6)}")
+        guardar = boton(at, "Guardar Cambios en Hoja Stock")
+        if guardar is not None:
+            guardar.click()
+            ejecutar(at, metricas, sesion, "guardar_hoja_stock")
+
+        # Buscar en la pestaña 2 (Filtrar Reactivos)
+        at.radio(key="grupo_filtrar").set_value(rng.choice(["limitante", "compartido"]))
+        ejecutar(at, metricas, sesion, "filtrar_grupo")
+        buscar = boton(at, "Buscar en Base Historial")
+        if buscar is not None:
+            buscar.click()
+            ejecutar(at, metricas, sesion, "buscar_historial")
+
+        # Consumir en la pestaña 3 (Informar Reactivo Agotado)
+        consumir = boton(at, "Consumir en Lab (memoria)")
+        if consumir is not None:
+            at.number_input(key="agotado_uds").set_value(1)
+            consumir.click()
+            ejecutar(at, metricas, sesion, "consumir")
+            guardar_consumo = boton(at, "Guardar Cambios en Consumo Lab")
+            if guardar_consumo is not None:
+                guardar_consumo.click()
+                ejecutar(at, metricas, sesion, "guardar_consumo")
+
+
+# ---------------------------------------------------------------------------------
+# Informe
+# ---------------------------------------------------------------------------------
+def informe(metricas: Metricas, duracion: float, n_sesiones: int, rss_inicial, rss_final) -> str:
+    df = pd.DataFrame(metricas.latencias, columns=["Acción", "Segundos"])
+    lineas = [f"Sesiones: {n_sesiones}   Reruns: {len(df)}   Duración: {duracion:.1f} s", ""]
+    if not df.empty:
+        por_accion = df.groupby("Acción")["Segundos"].describe(percentiles=[0.5, 0.95])
+        por_accion = por_accion[["count", "50%", "95%", "max"]].rename(
+            columns={"count": "n", "50%": "p50 (s)", "95%": "p95 (s)", "max": "máx (s)"}
+        )
+        lineas.append(f"Latencia de rerun global: p50 = {df['Segundos'].quantile(0.5):.3f} s, "
+                      f"p95 = {df['Segundos'].quantile(0.95):.3f} s")
+        lineas.append("")
+        lineas.append(por_accion.round(3).to_string())
+        lineas.append("")
+    lineas.append(f"Guardados: {metricas.guardados} de {metricas.intentos} intentos "
+                  f"({metricas.rechazos} rechazados por datos desfasados)   "
+                  f"Rendimiento: {metricas.guardados / duracion:.2f} guardados/s")
+    if rss_inicial is not None and rss_final is not None:
+        lineas.append(f"RSS: inicial {rss_inicial:.1f} MB, final {rss_final:.1f} MB, "
+                      f"por sesión ≈ {(rss_final - rss_inicial) / max(n_sesiones, 1):.1f} MB")
+    else:
+        lineas.append("RSS: no disponible en este sistema")
+    if metricas.errores:
+        lineas.append("")
+        lineas.append(f"Errores ({len(metricas.errores)}):")
+        for sesion, accion, mensaje in metricas.errores[:10]:
+            lineas.append(f"  sesión {sesion} / {accion}: {mensaje}")
+    return "\n".join(lineas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga con sesiones concurrentes (Streamlit AppTest).")
+    parser.add_argument("--sesiones", type=int, default=4, help="Sesiones concurrentes (por defecto 4)")
+    parser.add_argument("--iteraciones", type=int, default=3, help="Ciclos de flujo por sesión (por defecto 3)")
+    parser.add_argument("--filas", type=int, default=200, help="Filas por panel en la base A (por defecto 200)")
+    parser.add_argument("--filas-b", type=int, default=2000, help="Filas por hoja en la base B (por defecto 2000)")
+    parser.add_argument("--semilla", type=int, default=0, help="Semilla de los datos y acciones aleatorias")
+    parser.add_argument("--timeout", type=float, default=120, help="Tiempo máximo por rerun en segundos")
+    parser.add_argument("--con-esperas", action="store_true", help="No anular los time.sleep() de la app")
+    parser.add_argument("--conservar", action="store_true", help="No borrar el directorio temporal al terminar")
+    args = parser.parse_args(argv)
+
+    directorio = tempfile.mkdtemp(prefix="prueba_carga_stock_")
+    dir_original = os.getcwd()
+    sleep_original = time.sleep
+    parse_original = ast.parse
+    try:
+        generar_datos(directorio, args.filas, args.filas_b, args.semilla)
+        # La app trabaja con rutas relativas (versions/, versions_b/)
+        os.chdir(directorio)
+        if not args.con_esperas:
+            time.sleep = lambda *_: None
+        ast.parse = parse_serializado(parse_original)
+
+        metricas = Metricas()
+        versiones_iniciales = contar_versiones_a()
+        rss_inicial = rss_actual_mb()
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sesiones) as ejecutor:
+            futuros = [
+                ejecutor.submit(simular_sesion, i, args.iteraciones, metricas, args.semilla, args.timeout)
+                for i in range(args.sesiones)
+            ]
+            for i, futuro in enumerate(futuros):
+                try:
+                    futuro.result()
+                except Exception as e:
+                    metricas.error(i, "sesión", repr(e))
+        duracion = time.perf_counter() - inicio
+        rss_final = rss_actual_mb()
+        # Cada guardado completado escribe una versión nueva de A
+        metricas.guardados = contar_versiones_a() - versiones_iniciales
+
+        print(informe(metricas, duracion, args.sesiones, rss_inicial, rss_final))
+        # Falla con errores o si la mayoría de los guardados no llegaron a escribirse
+        return 1 if metricas.errores or metricas.guardados * 2 < metricas.intentos else 0
+    finally:
+        time.sleep = sleep_original
+        ast.parse = parse_original
+        os.chdir(dir_original)
+        if args.conservar:
+            print(f"\nDatos de la prueba en: {directorio}")
+        else:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,16 +3,30 @@ import streamlit_authenticator as stauth
 import pandas as pd
 import numpy as np
 import datetime
-import shutil
 import os
 from io import BytesIO
-import itertools
 import openpyxl
 import time
 import pytz
 import glob
 import sys
 import subprocess
+import difflib
+import threading
+import unicodedata
+import contextlib
+import re
+import uuid
+import hashlib
+import json
+import zlib
+
+import copia_seguridad
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
 import sys
 import subprocess
@@ -35,60 +49,77 @@ st.set_page_config(page_title="Control de Stock con Lotes", layout="centered")
 st.title("🔬 Control Stock Lab. Patología Molécular")
 
 # ---------------------------------------------------------------------------------
-# Autenticación
+# Particiones por laboratorio y directorios de versiones (locales)
 # ---------------------------------------------------------------------------------
-credentials = {
-    "usernames": {
-        "user1": {
-            "email": "user1@example.com",
-            "name": "admin",
-            "password": "$2b$12$j2s41NdHSUTSL.1xEM/GyeKX7dzMZTpyLnq7p/g/j2aldw.KC5FxS"
-        },
-        "user2": {
-            "email": "user2@example.com",
-            "name": "Usuario Dos",
-            "password": "$2b$12$F9F3nZL9eFQKyF2.0tKbEe2KKFZQ3LCO6X5FA5u2Lz8mL3yh5Ew0a"
-        }
-    }
-}
-
-cookie_key = "mi_cookie_secreta"
-signature_key = "mi_signature_secreta"
-
-authenticator = stauth.Authenticate(
-    credentials,
-    cookie_name=cookie_key,
-    key=signature_key,
-    cookie_expiry_days=1
-)
-
-
-# Inicialización segura
-authenticator.login(location="main")
-
-if st.session_state.get("authentication_status"):
-    st.success(f"Bienvenido, {st.session_state.get('name', 'usuario')}!")
-elif st.session_state.get("authentication_status") is False:
-    st.error("Usuario o contraseña incorrectos.")
-    st.stop()
-else:
-    st.warning("Por favor, ingresa tus credenciales.")
+# STOCK_DATA_ROOT: carpeta raíz de los datos (por defecto, la de la aplicación)
+# STOCK_LAB: fija el laboratorio de este proceso (un worker por laboratorio)
+# STOCK_LABS: laboratorios, separados por comas, que se ofrecen en el selector
+RAIZ_DATOS = os.environ.get("STOCK_DATA_ROOT", ".")
+DIR_LABORATORIOS = os.path.join(RAIZ_DATOS, "laboratorios")
+PARTICION_PRINCIPAL = "principal"
+PARTICION_FIJA = os.environ.get("STOCK_LAB", "").strip()
+
+def nombre_particion_valido(nombre: str) -> bool:
+    """Sólo letras, números, '_' y '-': el nombre se usa como carpeta."""
+    return bool(re.fullmatch(r"[A-Za-z0-9_-]+", nombre or ""))
+
+def raiz_particion(particion: str) -> str:
+    """La partición principal usa las carpetas de siempre (versions/ y versions_b/)."""
+    if particion == PARTICION_PRINCIPAL:
+        return RAIZ_DATOS
+    return os.path.join(DIR_LABORATORIOS, particion)
+
+def particiones_disponibles() -> list:
+    nombres = {p.strip() for p in os.environ.get("STOCK_LABS", "").split(",")}
+    if os.path.isdir(DIR_LABORATORIOS):
+        nombres.update(d for d in os.listdir(DIR_LABORATORIOS)
+                       if os.path.isdir(os.path.join(DIR_LABORATORIOS, d)))
+    nombres.discard(PARTICION_PRINCIPAL)
+    return [PARTICION_PRINCIPAL] + sorted(n for n in nombres if nombre_particion_valido(n))
+
+if PARTICION_FIJA and not nombre_particion_valido(PARTICION_FIJA):
+    st.error(f"STOCK_LAB='{PARTICION_FIJA}' no es un nombre de laboratorio válido.")
     st.stop()
 
+if "particion" not in st.session_state:
+    st.session_state["particion"] = PARTICION_FIJA or PARTICION_PRINCIPAL
 
-if st.button("Cerrar sesión"):
-    authenticator.logout()
-    st.rerun()
-
-# ---------------------------------------------------------------------------------
-# Directorios de versiones (locales)
-# ---------------------------------------------------------------------------------
-VERSIONS_DIR = "versions"         # Para la base de datos A
-VERSIONS_DIR_B = "versions_b"     # Para la base de datos B (Histórico)
+PARTICION = PARTICION_FIJA or st.session_state["particion"]
+RAIZ_PARTICION = raiz_particion(PARTICION)
+VERSIONS_DIR = os.path.normpath(os.path.join(RAIZ_PARTICION, "versions"))         # Para la base de datos A
+VERSIONS_DIR_B = os.path.normpath(os.path.join(RAIZ_PARTICION, "versions_b"))     # Para la base de datos B (Histórico)
 
 os.makedirs(VERSIONS_DIR, exist_ok=True)
 os.makedirs(VERSIONS_DIR_B, exist_ok=True)
 
+@contextlib.contextmanager
+def bloqueo_particion(raiz: str = None):
+    """
+    Bloqueo exclusivo entre procesos (y sesiones) sobre las carpetas de una partición.
+    Serializa los guardados, subidas y borrados de varios workers que comparten datos.
+    """
+    ruta = os.path.join(raiz or RAIZ_PARTICION, ".bloqueo")
+    with open(ruta, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK se rinde tras ~10 s: se sigue esperando
+                    continue
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
 # ---------------------------------------------------------------------------------
 # Inicialización de Session State
 # ---------------------------------------------------------------------------------
@@ -98,11 +129,20 @@ if "data_dict" not in st.session_state:
 if "data_dict_b" not in st.session_state:
     st.session_state["data_dict_b"] = {}
 
-# Banderas de control para evitar re-subida infinita
+# Movimientos escaneados pendientes de guardar (Entrada rápida)
+if "scan_pendientes" not in st.session_state:
+    st.session_state["scan_pendientes"] = []
+
+# Marca de A y B en disco cuando esta sesión cargó sus datos (ver guardar_versiones)
+if "marca_cargada" not in st.session_state:
+    st.session_state["marca_cargada"] = {}
+
+# file_id de la última subida procesada (evita re-procesarla en cada rerun,
+# pero permite subir otro archivo en la misma sesión)
 if "processed_a" not in st.session_state:
-    st.session_state["processed_a"] = False
+    st.session_state["processed_a"] = None
 if "processed_b" not in st.session_state:
-    st.session_state["processed_b"] = False
+    st.session_state["processed_b"] = None
 
 # ---------------------------------------------------------------------------------
 # Funciones auxiliares
@@ -117,11 +157,20 @@ def obtener_subcarpeta_versiones(base_dir: str) -> str:
     return ruta_subcarpeta
 
 def crear_nueva_version_filename(base_dir: str, prefix="Stock"):
-    """Genera un nombre de archivo único con fecha/hora en la carpeta base_dir."""
+    """
+    Genera un nombre de archivo único con fecha/hora en la carpeta base_dir.
+    Si otro proceso ya guardó en el mismo segundo se añade un sufijo (_2, _3...);
+    debe llamarse dentro de bloqueo_particion() para que sea único entre workers.
+    """
     ruta_subcarpeta = obtener_subcarpeta_versiones(base_dir)
     zona_local = pytz.timezone('Europe/Madrid')
     fh = datetime.datetime.now(zona_local).strftime("%Y-%m-%d_%H-%M-%S")
-    return os.path.join(ruta_subcarpeta, f"{prefix}_{fh}.xlsx")
+    ruta = os.path.join(ruta_subcarpeta, f"{prefix}_{fh}.xlsx")
+    n = 2
+    while os.path.exists(ruta):
+        ruta = os.path.join(ruta_subcarpeta, f"{prefix}_{fh}_{n}.xlsx")
+        n += 1
+    return ruta
 
 def generar_excel_en_memoria(df_act: pd.DataFrame, sheet_nm="Hoja1"):
     """Devuelve un Excel en memoria (bytes) con la hoja 'sheet_nm'."""
@@ -140,10 +189,423 @@ def obtener_ultima_version(base_dir: str, exclude_pattern=None):
     if exclude_pattern:
         archivos = [f for f in archivos if exclude_pattern not in f]
     if archivos:
-        ultima = max(archivos, key=os.path.getctime)
+        # Fecha de modificación: una versión restaurada desde la copia de seguridad
+        # conserva la suya y no pasa por delante de las más recientes
+        ultima = max(archivos, key=os.path.getmtime)
         return ultima
     return None
 
+# ---------------------------------------------------------------------------------
+# Esquema compacto en memoria (no altera el Excel que se escribe)
+# ---------------------------------------------------------------------------------
+# Columnas de texto con pocos valores distintos repetidos en miles de filas
+COLS_CATEGORICAS = ["Tª", "Sitio almacenaje", "Nombre producto", "(Hoja B)", "Usuario"]
+# Enteros pequeños con soporte de nulos
+COLS_ENTERAS = {"Ref. Saturno": "Int32", "Uds.": "Int16", "Stock": "Int32"}
+
+def _a_categoria(serie: pd.Series) -> pd.Series:
+    """Convierte a categoría incluyendo siempre "" para poder vaciar celdas."""
+    cat = serie.astype("category")
+    if "" not in cat.cat.categories:
+        cat = cat.cat.add_categories("")
+    return cat
+
+def _a_entero_compacto(serie: pd.Series, dtype: str) -> pd.Series:
+    """Entero nullable del menor tamaño en el que caben los valores."""
+    if dtype == "Int16" and serie.notna().any() and serie.abs().max() > np.iinfo(np.int16).max:
+        dtype = "Int32"
+    if dtype == "Int32" and serie.notna().any() and serie.abs().max() > np.iinfo(np.int32).max:
+        dtype = "Int64"
+    return serie.astype(dtype)
+
+def compactar_tipos(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aplica el esquema compacto sin perder información: categorías para las etiquetas
+    repetidas y enteros nullable sólo si todos los valores numéricos son enteros.
+    """
+    for col in COLS_CATEGORICAS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = _a_categoria(df[col])
+    for col, dtype in COLS_ENTERAS.items():
+        if (col in df.columns and pd.api.types.is_numeric_dtype(df[col])
+                and not pd.api.types.is_bool_dtype(df[col])):
+            valores = df[col].dropna()
+            if (valores % 1 == 0).all():
+                df[col] = _a_entero_compacto(df[col], dtype)
+    return df
+
+def normalizar_datos_cargados(datos: dict) -> dict:
+    """Texto sin nulos ("") y esquema compacto para las hojas recién leídas del Excel."""
+    for sheet, df in datos.items():
+        for col in df.select_dtypes(include=['object']).columns:
+            df[col] = df[col].where(df[col].notna(), "").astype(str)
+        datos[sheet] = compactar_tipos(df)
+    return datos
+
+def leer_version(ruta: str) -> dict:
+    """Lectura completa de una versión de A o B, con la normalización de la carga automática."""
+    return normalizar_datos_cargados(pd.read_excel(ruta, sheet_name=None, engine="openpyxl"))
+
+def informe_memoria(datos: dict, base: str) -> pd.DataFrame:
+    """Memoria por hoja con el esquema compacto frente al equivalente con str/int64."""
+    filas = []
+    for hoja, df in datos.items():
+        tipos_previos = {}
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                tipos_previos[col] = object
+            elif col in COLS_ENTERAS and pd.api.types.is_extension_array_dtype(df[col]):
+                tipos_previos[col] = "float64" if df[col].isna().any() else "int64"
+        sin_compactar = df.astype(tipos_previos)
+        filas.append({
+            "Base": base,
+            "Hoja": hoja,
+            "Filas": len(df),
+            "Antes (KB)": round(sin_compactar.memory_usage(deep=True).sum() / 1024, 1),
+            "Ahora (KB)": round(df.memory_usage(deep=True).sum() / 1024, 1),
+        })
+    return pd.DataFrame(filas)
+
+# Índices derivados que se mantienen en session_state (se reconstruyen al cargar datos nuevos)
+INDICES_SESION = [
+    "indice_caducidad", "tabla_alarmas", "indice_compartidos", "indice_busqueda",
+    "estado_prevision", "prevision_consumo", "indice_auditoria", "aud_export"
+]
+
+def invalidar_indices():
+    """Elimina los índices derivados para que se reconstruyan con los datos recién cargados."""
+    for clave in INDICES_SESION:
+        st.session_state.pop(clave, None)
+
+# ---------------------------------------------------------------------------------
+# Caché global del proceso (compartida en sólo lectura por todas las sesiones)
+# ---------------------------------------------------------------------------------
+# Columnas auxiliares de la vista que nunca se escriben en el Excel de A
+COLS_INTERNAS = ["ColorGroup", "EsTitulo", "GroupCount", "MultiSort", "NotTitulo", "GroupID", "Alarma", "nombre_ref"]
+
+@st.cache_resource
+def _cache_global(particion: str) -> dict:
+    """
+    Última versión conocida de A y B de una partición, una sola vez por proceso.
+    'bases': base -> (carpeta de versiones, patrón de archivos a excluir).
+    """
+    raiz = raiz_particion(particion)
+    return {
+        "lock": threading.Lock(),
+        "raiz": raiz,
+        "bases": {
+            "A": (os.path.normpath(os.path.join(raiz, "versions")), "SubidoB_"),
+            "B": (os.path.normpath(os.path.join(raiz, "versions_b")), "SubidoA_"),
+        },
+        "A": None,
+        "B": None,
+    }
+
+def _ruta_marca(cache: dict, base: str) -> str:
+    return os.path.join(cache["raiz"], f".marca_{base}")
+
+def _leer_marca(cache: dict, base: str) -> str:
+    """Marca de la última escritura de 'base' por cualquier proceso ("" si no hay)."""
+    try:
+        with open(_ruta_marca(cache, base), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def _nueva_marca(cache: dict, base: str) -> str:
+    """Avisa a los demás workers de la partición de que 'base' ha cambiado en disco."""
+    marca = uuid.uuid4().hex
+    ruta = _ruta_marca(cache, base)
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, "w") as f:
+        f.write(marca)
+    os.replace(temporal, ruta)
+    return marca
+
+def _copiar_datos(datos: dict) -> dict:
+    return {hoja: df.copy() for hoja, df in datos.items()}
+
+def _cargar_en_cache(cache: dict, base: str):
+    """
+    Lee del disco la última versión de 'base' sólo si la caché no la tiene o si
+    otro proceso ha guardado desde entonces (su marca no coincide).
+    """
+    with cache["lock"]:
+        marca = _leer_marca(cache, base)
+        if cache[base] is None or cache[base]["marca"] != marca:
+            base_dir, excluir = cache["bases"][base]
+            ruta = obtener_ultima_version(base_dir, exclude_pattern=excluir)
+            if ruta is None:
+                cache[base] = None
+                return None
+            cache[base] = {"ruta": ruta, "datos": leer_version(ruta), "marca": marca}
+        return cache[base]
+
+def cargar_ultima_version_global(base: str):
+    """
+    Devuelve (ruta, datos) de la última versión de la base 'A' o 'B' de la partición actual.
+    Los datos salen de la caché del proceso; cada sesión recibe su propia copia.
+    """
+    cache = _cache_global(PARTICION)
+    entrada = _cargar_en_cache(cache, base)
+    if entrada is None:
+        st.session_state["marca_cargada"][base] = _leer_marca(cache, base)
+        return None, {}
+    st.session_state["marca_cargada"][base] = entrada["marca"]
+    return entrada["ruta"], _copiar_datos(entrada["datos"])
+
+def publicar_version_global(base: str, ruta: str, datos: dict):
+    """
+    Sustituye la versión en caché por la que se acaba de guardar o subir (sin releer
+    el disco). La sesión que la publica pasa a tener los datos de esa marca.
+    """
+    cache = _cache_global(PARTICION)
+    copia = {hoja: compactar_tipos(df.drop(columns=COLS_INTERNAS, errors="ignore"))
+             for hoja, df in datos.items()}
+    with cache["lock"]:
+        marca = _nueva_marca(cache, base)
+        cache[base] = {"ruta": ruta, "datos": copia, "marca": marca}
+    st.session_state["marca_cargada"][base] = marca
+
+def invalidar_version_global(base: str):
+    """
+    Obliga a buscar de nuevo la última versión (p. ej. tras borrar versiones o restaurar
+    una copia). La sesión que lo hace descarta sus datos de 'base' y recarga la última
+    versión en la siguiente ejecución, como tras una subida.
+    """
+    cache = _cache_global(PARTICION)
+    with cache["lock"]:
+        _nueva_marca(cache, base)
+        cache[base] = None
+    st.session_state["data_dict" if base == "A" else "data_dict_b"] = {}
+    st.session_state["marca_cargada"].pop(base, None)
+    invalidar_indices()
+
+@st.cache_resource
+def iniciar_precarga(particion: str):
+    """Precarga A y B de la partición en segundo plano la primera vez que se usa en el proceso."""
+    cache = _cache_global(particion)
+
+    def _precargar():
+        for base in ("A", "B"):
+            try:
+                _cargar_en_cache(cache, base)
+            except Exception:
+                # Si falla, la sesión lo reintentará y mostrará el error al cargar
+                pass
+
+    hilo = threading.Thread(target=_precargar, name=f"precarga_stock_{particion}", daemon=True)
+    hilo.start()
+    return hilo
+
+# Se lanza antes del login: el análisis de A y B avanza mientras el usuario se identifica
+iniciar_precarga(PARTICION)
+
+# ---------------------------------------------------------------------------------
+# Copia de seguridad de versions/ y versions_b/
+# ---------------------------------------------------------------------------------
+# El destino lo fija quien administra el servidor (STOCK_BACKUP_DIR), no los usuarios de la app
+DESTINO_BACKUP = copia_seguridad.destino_por_defecto()
+
+def destino_copia_particion(destino: str) -> str:
+    """Cada laboratorio se copia en su propia subcarpeta del destino (la principal, en la raíz)."""
+    if not destino or PARTICION == PARTICION_PRINCIPAL:
+        return destino
+    return os.path.join(destino, "laboratorios", PARTICION)
+
+def copia_antes_de_borrar() -> bool:
+    """
+    Hace una copia incremental antes de un borrado masivo si hay destino configurado.
+    Devuelve False si la copia falla (y el borrado no debe continuar). Se llama con el
+    bloqueo de la partición ya tomado, para que nadie guarde entre la copia y el borrado.
+    """
+    destino = DESTINO_BACKUP
+    if not destino:
+        st.warning("No hay destino de copia de seguridad configurado: se borra sin copia previa.")
+        return True
+    try:
+        resumen = copia_seguridad.hacer_copia(destino_copia_particion(destino), RAIZ_PARTICION)
+        st.info(f"Copia de seguridad previa: {resumen['copiados']} archivo(s) nuevos copiados en {destino}.")
+        return True
+    except Exception as e:
+        st.error(f"No se pudo hacer la copia de seguridad previa ({e}). No se ha borrado nada.")
+        return False
+
+# ---------------------------------------------------------------------------------
+# Subida de archivos A/B: copia con hash, sin duplicados y con validación previa
+# ---------------------------------------------------------------------------------
+# Columnas sin las que la aplicación no puede trabajar con una hoja
+COLS_OBLIGATORIAS = {
+    "A": ["Ref. Saturno", "Ref. Fisher", "Nombre producto", "NºLote", "Stock"],
+    "B": ["Ref. Fisher", "Nombre producto", "NºLote"],
+}
+
+def _volcar_con_hash(archivo, ruta_destino: str) -> str:
+    """Escribe el archivo subido por bloques calculando su SHA-256 a la vez."""
+    h = hashlib.sha256()
+    archivo.seek(0)
+    with open(ruta_destino, "wb") as out_file:
+        for bloque in iter(lambda: archivo.read(copia_seguridad.TAM_BLOQUE), b""):
+            h.update(bloque)
+            out_file.write(bloque)
+    return h.hexdigest()
+
+def buscar_duplicado(base_dir: str, tamano: int, sha: str):
+    """
+    Ruta de una versión ya guardada con el mismo contenido, o None.
+    Sólo se calcula el hash de los archivos del mismo tamaño.
+    """
+    for ruta in glob.glob(f"{base_dir}/**/*.xlsx", recursive=True):
+        if os.path.getsize(ruta) == tamano and copia_seguridad.hash_archivo(ruta) == sha:
+            return ruta
+    return None
+
+def validar_esquema_excel(ruta: str, base: str) -> list:
+    """
+    Comprueba hojas y cabeceras leyendo sólo la primera fila de cada hoja (modo
+    read_only de openpyxl), antes del análisis completo. Devuelve los errores.
+    """
+    errores = []
+    # Se abre como archivo: openpyxl rechaza por extensión las rutas que no son .xlsx
+    with open(ruta, "rb") as f:
+        try:
+            wb = openpyxl.load_workbook(f, read_only=True)
+        except Exception as e:
+            return [f"no es un Excel (.xlsx) válido ({e})"]
+        try:
+            if not wb.sheetnames:
+                errores.append("el archivo no tiene hojas")
+            for hoja in wb.sheetnames:
+                cabecera = next(wb[hoja].iter_rows(max_row=1, values_only=True), ())
+                columnas = [str(c).strip() for c in cabecera if c is not None]
+                if not columnas:
+                    errores.append(f"hoja '{hoja}': sin cabecera")
+                    continue
+                faltan = [c for c in COLS_OBLIGATORIAS[base] if c not in columnas]
+                if faltan:
+                    errores.append(f"hoja '{hoja}': faltan columnas {', '.join(faltan)}")
+                repetidas = sorted({c for c in columnas if columnas.count(c) > 1})
+                if repetidas:
+                    errores.append(f"hoja '{hoja}': columnas repetidas {', '.join(repetidas)}")
+        finally:
+            wb.close()
+    return errores
+
+def _datos_en_cache(base: str, ruta: str):
+    """Copia de los datos en caché si corresponden a 'ruta' (evita releer el Excel)."""
+    cache = _cache_global(PARTICION)
+    with cache["lock"]:
+        entrada = cache[base]
+        if entrada is not None and os.path.abspath(entrada["ruta"]) == os.path.abspath(ruta):
+            return _copiar_datos(entrada["datos"])
+    return None
+
+def procesar_subida(archivo, base: str) -> dict:
+    """
+    Guarda una subida de A o B como nueva versión y devuelve {"ruta", "datos", "duplicado"}.
+
+    El archivo se vuelca a un temporal calculando su hash; si ya existe una versión
+    idéntica no se guarda otra copia, sólo se marca como la más reciente. Si es nuevo,
+    se valida su esquema antes de analizarlo y no se publica si no es válido
+    (lanza ValueError con los errores).
+    """
+    base_dir = VERSIONS_DIR if base == "A" else VERSIONS_DIR_B
+    ruta_sub = obtener_subcarpeta_versiones(base_dir)
+    temporal = os.path.join(ruta_sub, f".subida_{uuid.uuid4().hex}.tmp")
+    try:
+        sha = _volcar_con_hash(archivo, temporal)
+        duplicado = buscar_duplicado(base_dir, os.path.getsize(temporal), sha)
+        if duplicado:
+            ruta = duplicado
+            datos = _datos_en_cache(base, ruta)
+            if datos is None:
+                datos = leer_version(ruta)
+            with bloqueo_particion():
+                os.utime(ruta)  # pasa a ser la última versión (por fecha de modificación)
+                publicar_version_global(base, ruta, datos)
+        else:
+            errores = validar_esquema_excel(temporal, base)
+            if errores:
+                raise ValueError("; ".join(errores))
+            datos = leer_version(temporal)
+            with bloqueo_particion():
+                ruta = crear_nueva_version_filename(base_dir, prefix=f"Subido{base}")
+                os.replace(temporal, ruta)
+                publicar_version_global(base, ruta, datos)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return {"ruta": ruta, "datos": datos, "duplicado": bool(duplicado)}
+
+# ---------------------------------------------------------------------------------
+# Autenticación
+# ---------------------------------------------------------------------------------
+credentials = {
+    "usernames": {
+        "user1": {
+            "email": "user1@example.com",
+            "name": "admin",
+            "password": "$2b$12$j2s41NdHSUTSL.1xEM/GyeKX7dzMZTpyLnq7p/g/j2aldw.KC5FxS"
+        },
+        "user2": {
+            "email": "user2@example.com",
+            "name": "Usuario Dos",
+            "password": "$2b$12$F9F3nZL9eFQKyF2.0tKbEe2KKFZQ3LCO6X5FA5u2Lz8mL3yh5Ew0a"
+        }
+    }
+}
+
+cookie_key = "mi_cookie_secreta"
+signature_key = "mi_signature_secreta"
+
+authenticator = stauth.Authenticate(
+    credentials,
+    cookie_name=cookie_key,
+    key=signature_key,
+    cookie_expiry_days=1
+)
+
+
+# Inicialización segura
+authenticator.login(location="main")
+
+if st.session_state.get("authentication_status"):
+    st.success(f"Bienvenido, {st.session_state.get('name', 'usuario')}!")
+elif st.session_state.get("authentication_status") is False:
+    st.error("Usuario o contraseña incorrectos.")
+    st.stop()
+else:
+    st.warning("Por favor, ingresa tus credenciales.")
+    st.stop()
+
+
+if st.button("Cerrar sesión"):
+    authenticator.logout()
+    st.rerun()
+
+# ---------------------------------------------------------------------------------
+# SideBar: laboratorio (partición de datos)
+# ---------------------------------------------------------------------------------
+def cambiar_particion():
+    """Al cambiar de laboratorio se descartan los datos e índices del anterior."""
+    st.session_state["particion"] = st.session_state["particion_sel"]
+    st.session_state["data_dict"] = {}
+    st.session_state["data_dict_b"] = {}
+    st.session_state["scan_pendientes"] = []
+    st.session_state.pop("scan_ambiguo", None)
+    st.session_state["marca_cargada"] = {}
+    invalidar_indices()
+
+if PARTICION_FIJA:
+    st.sidebar.caption(f"🏥 Laboratorio: **{PARTICION}**")
+else:
+    particiones = particiones_disponibles()
+    if len(particiones) > 1:
+        st.sidebar.selectbox(
+            "🏥 Laboratorio:", particiones, index=particiones.index(PARTICION) if PARTICION in particiones else 0,
+            key="particion_sel", on_change=cambiar_particion
+        )
+
 # ---------------------------------------------------------------------------------
 # SideBar: subida/gestor de versiones para la base A
 # ---------------------------------------------------------------------------------
@@ -152,18 +614,13 @@ st.sidebar.header("Gestor de la Base A")
 with st.sidebar.expander("Cargar / Explorar versiones (A)", expanded=False):
     # Intentar cargar la última versión si no hay datos en session_state
     if not st.session_state["data_dict"]:
-        ultima_a = obtener_ultima_version(VERSIONS_DIR, exclude_pattern="SubidoB_")
-        if ultima_a:
-            try:
-                data_a = pd.read_excel(ultima_a, sheet_name=None, engine="openpyxl")
-                for sheet, df in data_a.items():
-                    for col in df.select_dtypes(include=['object']).columns:
-                        df[col] = df[col].apply(lambda x: str(x) if not pd.isnull(x) else "")
-                    data_a[sheet] = df
+        try:
+            ultima_a, data_a = cargar_ultima_version_global("A")
+            if ultima_a:
                 st.session_state["data_dict"] = data_a
                 st.info(f"Se cargó automáticamente la última versión A: {ultima_a}")
-            except Exception as e:
-                st.error(f"Error al cargar '{ultima_a}': {e}")
+        except Exception as e:
+            st.error(f"Error al cargar la última versión A: {e}")
 
     # Desplegamos subcarpetas de versiones
     subcarpetas_a = sorted(
@@ -204,7 +661,9 @@ with st.sidebar.expander("Cargar / Explorar versiones (A)", expanded=False):
                 confirm_eliminar = st.text_input("Escribe ELIMINAR para borrar", key="confirm_del_avanzado")
                 if st.button("Eliminar versión seleccionada"):
                     if confirm_eliminar == "ELIMINAR":
-                        os.remove(ruta_version)
+                        with bloqueo_particion():
+                            os.remove(ruta_version)
+                            invalidar_version_global("A")
                         st.success("Versión eliminada correctamente.")
                         time.sleep(1.5)
                         st.rerun()
@@ -220,37 +679,41 @@ with st.sidebar.expander("Cargar / Explorar versiones (A)", expanded=False):
     confirm_all_del_a = st.text_input("Escribe ELIMINAR TODO para confirmar", key="confirm_all_del_a")
     if st.button("🗑️ Eliminar todas las versiones A"):
         if confirm_all_del_a == "ELIMINAR TODO":
-            for subdir, dirs, files in os.walk(VERSIONS_DIR):
-                for file in files:
-                    os.remove(os.path.join(subdir, file))
-            st.success("Todas las versiones de A han sido eliminadas.")
-            time.sleep(2)
-            st.rerun()
+            with bloqueo_particion():
+                copiado = copia_antes_de_borrar()
+                if copiado:
+                    for subdir, dirs, files in os.walk(VERSIONS_DIR):
+                        for file in files:
+                            os.remove(os.path.join(subdir, file))
+                    invalidar_version_global("A")
+            if copiado:
+                st.success("Todas las versiones de A han sido eliminadas.")
+                time.sleep(2)
+                st.rerun()
         else:
             st.error("Debes escribir 'ELIMINAR TODO' para confirmar.")
 
     # Subir archivo A manualmente
     archivo_subido_a = st.file_uploader("Subir archivo A (.xlsx)", type=["xlsx"], key="uploader_a")
 
-    # Si hay archivo y todavía no lo hemos procesado en esta sesión
-    if archivo_subido_a and not st.session_state["processed_a"]:
-        st.session_state["processed_a"] = True
-
-        nombre_archivo_subido = f"SubidoA_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.xlsx"
-        ruta_sub = obtener_subcarpeta_versiones(VERSIONS_DIR)
-        ruta_guardado = os.path.join(ruta_sub, nombre_archivo_subido)
-
-        with open(ruta_guardado, "wb") as out_file:
-            shutil.copyfileobj(archivo_subido_a, out_file)
+    if "aviso_subida_a" in st.session_state:
+        st.success(st.session_state.pop("aviso_subida_a"))
 
+    # Si hay archivo y todavía no hemos procesado esta subida (cada subida tiene su file_id)
+    if archivo_subido_a and st.session_state["processed_a"] != archivo_subido_a.file_id:
+        st.session_state["processed_a"] = archivo_subido_a.file_id
         try:
-            data_subida = pd.read_excel(ruta_guardado, sheet_name=None, engine="openpyxl")
-            for sheet, df in data_subida.items():
-                for col in df.select_dtypes(include=['object']).columns:
-                    df[col] = df[col].apply(lambda x: str(x) if not pd.isnull(x) else "")
-                data_subida[sheet] = df
-            st.session_state["data_dict"] = data_subida
-            st.success(f"✅ Archivo A '{nombre_archivo_subido}' importado correctamente.")
+            subida = procesar_subida(archivo_subido_a, "A")
+            st.session_state["data_dict"] = subida["datos"]
+            invalidar_indices()
+            nombre_archivo_subido = os.path.basename(subida["ruta"])
+            if subida["duplicado"]:
+                st.session_state["aviso_subida_a"] = (
+                    f"✅ El archivo A ya estaba guardado como '{nombre_archivo_subido}': "
+                    "se ha cargado sin crear otra copia."
+                )
+            else:
+                st.session_state["aviso_subida_a"] = f"✅ Archivo A '{nombre_archivo_subido}' importado correctamente."
             st.rerun()
         except Exception as e:
             st.error(f"❌ Error al procesar el archivo A: {e}")
@@ -265,18 +728,13 @@ st.sidebar.header("Gestor de la Base B (Histórico)")
 
 with st.sidebar.expander("Cargar / Explorar versiones (B)", expanded=False):
     if not st.session_state["data_dict_b"]:
-        ultima_b = obtener_ultima_version(VERSIONS_DIR_B, exclude_pattern="SubidoA_")
-        if ultima_b:
-            try:
-                data_b = pd.read_excel(ultima_b, sheet_name=None, engine="openpyxl")
-                for sheet, df in data_b.items():
-                    for col in df.select_dtypes(include=['object']).columns:
-                        df[col] = df[col].apply(lambda x: str(x) if not pd.isnull(x) else "")
-                    data_b[sheet] = df
+        try:
+            ultima_b, data_b = cargar_ultima_version_global("B")
+            if ultima_b:
                 st.session_state["data_dict_b"] = data_b
                 st.info(f"Se cargó automáticamente la última versión B: {ultima_b}")
-            except Exception as e:
-                st.error(f"Error al cargar '{ultima_b}': {e}")
+        except Exception as e:
+            st.error(f"Error al cargar la última versión B: {e}")
 
     subcarpetas_b = sorted(
         [d for d in os.listdir(VERSIONS_DIR_B) if os.path.isdir(os.path.join(VERSIONS_DIR_B, d))],
@@ -317,7 +775,9 @@ with st.sidebar.expander("Cargar / Explorar versiones (B)", expanded=False):
                 confirm_eliminar_b = st.text_input("Escribe ELIMINAR para borrar versión B", key="confirm_del_avanzado_b")
                 if st.button("Eliminar versión B seleccionada"):
                     if confirm_eliminar_b == "ELIMINAR":
-                        os.remove(ruta_version_b)
+                        with bloqueo_particion():
+                            os.remove(ruta_version_b)
+                            invalidar_version_global("B")
                         st.success("Versión B eliminada correctamente.")
                         time.sleep(1.5)
                         st.rerun()
@@ -333,48 +793,109 @@ with st.sidebar.expander("Cargar / Explorar versiones (B)", expanded=False):
     confirm_all_del_b = st.text_input("Escribe ELIMINAR TODO para confirmar", key="confirm_all_del_b")
     if st.button("🗑️ Eliminar todas las versiones B"):
         if confirm_all_del_b == "ELIMINAR TODO":
-            for subdir, dirs, files in os.walk(VERSIONS_DIR_B):
-                for file in files:
-                    os.remove(os.path.join(subdir, file))
-            st.success("Todas las versiones de B han sido eliminadas.")
-            time.sleep(2)
-            st.rerun()
+            with bloqueo_particion():
+                copiado = copia_antes_de_borrar()
+                if copiado:
+                    for subdir, dirs, files in os.walk(VERSIONS_DIR_B):
+                        for file in files:
+                            os.remove(os.path.join(subdir, file))
+                    invalidar_version_global("B")
+            if copiado:
+                st.success("Todas las versiones de B han sido eliminadas.")
+                time.sleep(2)
+                st.rerun()
         else:
             st.error("Debes escribir 'ELIMINAR TODO' para confirmar.")
 
     # Subir archivo B manualmente (CORREGIDO)
     archivo_subido_b = st.file_uploader("Subir archivo B (.xlsx)", type=["xlsx"], key="uploader_b")
 
-    # Si hay archivo y no está procesado aún
-    if archivo_subido_b and not st.session_state["processed_b"]:
-        st.session_state["processed_b"] = True
-
-        nombre_archivo_subido_b = f"SubidoB_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.xlsx"
-        ruta_sub_b = obtener_subcarpeta_versiones(VERSIONS_DIR_B)
-        ruta_guardado_b = os.path.join(ruta_sub_b, nombre_archivo_subido_b)
-
-        with open(ruta_guardado_b, "wb") as out_file_b:
-            shutil.copyfileobj(archivo_subido_b, out_file_b)
+    if "aviso_subida_b" in st.session_state:
+        st.success(st.session_state.pop("aviso_subida_b"))
 
+    # Si hay archivo y no está procesado aún (cada subida tiene su file_id)
+    if archivo_subido_b and st.session_state["processed_b"] != archivo_subido_b.file_id:
+        st.session_state["processed_b"] = archivo_subido_b.file_id
         try:
-            # Leemos EXCLUSIVAMENTE el archivo subido (B)
-            data_subida_b = pd.read_excel(ruta_guardado_b, sheet_name=None, engine="openpyxl")
-
-            # Convertir columnas 'object' en cadenas (evita problemas de np.nan)
-            for sheet, df in data_subida_b.items():
-                for col in df.select_dtypes(include=['object']).columns:
-                    df[col] = df[col].apply(lambda x: str(x) if not pd.isnull(x) else "")
-                data_subida_b[sheet] = df
+            # Leemos EXCLUSIVAMENTE el archivo subido (B), validado y normalizado como en la carga automática
+            subida_b = procesar_subida(archivo_subido_b, "B")
 
             # Guardamos en session_state para su uso
-            st.session_state["data_dict_b"] = data_subida_b
-            st.success(f"✅ Archivo B '{nombre_archivo_subido_b}' importado correctamente.")
+            st.session_state["data_dict_b"] = subida_b["datos"]
+            invalidar_indices()
+            nombre_archivo_subido_b = os.path.basename(subida_b["ruta"])
+            if subida_b["duplicado"]:
+                st.session_state["aviso_subida_b"] = (
+                    f"✅ El archivo B ya estaba guardado como '{nombre_archivo_subido_b}': "
+                    "se ha cargado sin crear otra copia."
+                )
+            else:
+                st.session_state["aviso_subida_b"] = f"✅ Archivo B '{nombre_archivo_subido_b}' importado correctamente."
             st.rerun()
 
         except Exception as e:
             st.error(f"❌ Error al procesar el archivo B: {e}")
 
-# Tras la recarga, volvemos a poner la bandera en False
+# ---------------------------------------------------------------------------------
+# SideBar: copia de seguridad incremental
+# ---------------------------------------------------------------------------------
+st.sidebar.header("Copia de seguridad")
+
+with st.sidebar.expander("Copia de versions/ y versions_b/", expanded=False):
+    if not DESTINO_BACKUP:
+        st.info("No hay destino configurado. Defina la variable de entorno STOCK_BACKUP_DIR en el servidor.")
+    else:
+        destino_backup = destino_copia_particion(DESTINO_BACKUP)
+        st.caption(f"Destino: {destino_backup}")
+        manifiesto_backup = (copia_seguridad.cargar_manifiesto(destino_backup)
+                             if os.path.isdir(destino_backup) else {})
+        if manifiesto_backup.get("actualizado"):
+            st.caption(
+                f"Última copia: {manifiesto_backup['actualizado']} "
+                f"({len(manifiesto_backup.get('archivos', {}))} archivos en el manifiesto)"
+            )
+
+        col_copia, col_verif = st.columns(2)
+        with col_copia:
+            if st.button("Hacer copia", key="backup_copiar"):
+                try:
+                    # Con el bloqueo: no se copia un libro que otro worker esté escribiendo
+                    with bloqueo_particion():
+                        r = copia_seguridad.hacer_copia(destino_backup, RAIZ_PARTICION)
+                    st.success(
+                        f"Copiados {r['copiados']} archivo(s) ({r['bytes_copiados'] / 1024 ** 2:.1f} MB), "
+                        f"{r['sin_cambios']} sin cambios, en {r['segundos']} s."
+                    )
+                except Exception as e:
+                    st.error(f"Error en la copia de seguridad: {e}")
+        with col_verif:
+            if st.button("Verificar copia", key="backup_verificar"):
+                if not os.path.isdir(destino_backup):
+                    st.error("La carpeta de destino no existe.")
+                else:
+                    problemas = copia_seguridad.verificar_copia(destino_backup)
+                    if problemas:
+                        st.error(f"{len(problemas)} archivo(s) no coinciden con el manifiesto.")
+                        st.dataframe(pd.DataFrame(problemas, columns=["Archivo", "Problema"]))
+                    else:
+                        st.success("Copia verificada: todos los archivos coinciden con el manifiesto.")
+
+        st.divider()
+        confirm_restaurar = st.text_input("Escribe RESTAURAR para confirmar", key="confirm_restaurar")
+        if st.button("Restaurar desde la copia", key="backup_restaurar"):
+            if confirm_restaurar != "RESTAURAR":
+                st.error("Debes escribir RESTAURAR para confirmar.")
+            elif not os.path.isdir(destino_backup):
+                st.error("La carpeta de destino no existe.")
+            else:
+                with bloqueo_particion():
+                    r = copia_seguridad.restaurar_copia(destino_backup, RAIZ_PARTICION)
+                    invalidar_version_global("A")
+                    invalidar_version_global("B")
+                if r["errores"]:
+                    st.error(f"{len(r['errores'])} archivo(s) no se pudieron restaurar.")
+                    st.dataframe(pd.DataFrame(r["errores"], columns=["Archivo", "Problema"]))
+                st.success(f"Restaurados {r['restaurados']} archivo(s); {r['sin_cambios']} ya estaban intactos.")
 
 
 
@@ -382,30 +903,860 @@ with st.sidebar.expander("Cargar / Explorar versiones (B)", expanded=False):
 # Funciones de normalización
 # ---------------------------------------------------------------------------------
 def enforce_types(df: pd.DataFrame):
-    if "Ref. Saturno" in df.columns:
-        df["Ref. Saturno"] = pd.to_numeric(df["Ref. Saturno"], errors="coerce").fillna(0).astype(int)
+    for col in ["Ref. Saturno", "Uds.", "Stock"]:
+        if col in df.columns:
+            valores = pd.to_numeric(df[col], errors="coerce").fillna(0).astype("int64")
+            df[col] = _a_entero_compacto(valores, COLS_ENTERAS[col])
     if "Ref. Fisher" in df.columns:
         df["Ref. Fisher"] = df["Ref. Fisher"].astype(str)
-    if "Nombre producto" in df.columns:
-        df["Nombre producto"] = df["Nombre producto"].astype(str)
-    if "Tª" in df.columns:
-        df["Tª"] = df["Tª"].astype(str)
-    if "Uds." in df.columns:
-        df["Uds."] = pd.to_numeric(df["Uds."], errors="coerce").fillna(0).astype(int)
+    for col in ["Nombre producto", "Tª", "Sitio almacenaje", "(Hoja B)"]:
+        if col in df.columns:
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(str)
+            df[col] = _a_categoria(df[col])
     if "NºLote" in df.columns:
         df["NºLote"] = df["NºLote"].astype(str).fillna("")
     for col in ["Caducidad","Fecha Pedida","Fecha Llegada"]:
         if col in df.columns:
             df[col] = pd.to_datetime(df[col], errors="coerce")
-    if "Sitio almacenaje" in df.columns:
-        df["Sitio almacenaje"] = df["Sitio almacenaje"].astype(str)
-    if "Stock" in df.columns:
-        df["Stock"] = pd.to_numeric(df["Stock"], errors="coerce").fillna(0).astype(int)
     return df
 
+# ---------------------------------------------------------------------------------
+# Guardado de versiones y registros del histórico
+# ---------------------------------------------------------------------------------
+def _escribir_version_a() -> str:
+    """Escribe todas las hojas de A en una nueva versión y devuelve su ruta."""
+    new_file_a = crear_nueva_version_filename(VERSIONS_DIR, prefix="StockA")
+    with pd.ExcelWriter(new_file_a, engine="openpyxl") as writer:
+        for sht, df_sht in st.session_state["data_dict"].items():
+            tmp = df_sht.drop(columns=COLS_INTERNAS, errors="ignore")
+            tmp.to_excel(writer, sheet_name=sht, index=False)
+    publicar_version_global("A", new_file_a, st.session_state["data_dict"])
+    return new_file_a
+
+def _escribir_version_b() -> str:
+    """Escribe todas las hojas de B en una nueva versión y devuelve su ruta."""
+    new_file_b = crear_nueva_version_filename(VERSIONS_DIR_B, prefix="StockB")
+    with pd.ExcelWriter(new_file_b, engine="openpyxl") as writer_b:
+        for sht_b, df_sht_b in st.session_state["data_dict_b"].items():
+            df_sht_b.to_excel(writer_b, sheet_name=sht_b, index=False)
+    publicar_version_global("B", new_file_b, st.session_state["data_dict_b"])
+    return new_file_b
+
+def guardar_versiones(*bases) -> dict:
+    """
+    Guarda en una nueva versión cada base indicada ("A", "B") y devuelve base -> ruta.
+
+    Con el bloqueo de la partición se comprueba primero que nadie (otra sesión u otro
+    worker) haya guardado esas bases desde que esta sesión cargó sus datos. Si alguna
+    ha cambiado no se escribe nada, se descartan los datos de la sesión para que se
+    recargue la última versión y se lanza ValueError.
+    """
+    cache = _cache_global(PARTICION)
+    escribir = {"A": _escribir_version_a, "B": _escribir_version_b}
+    with bloqueo_particion():
+        cambiadas = [b for b in bases
+                     if _leer_marca(cache, b) != st.session_state["marca_cargada"].get(b, "")]
+        if cambiadas:
+            for b in bases:
+                st.session_state["data_dict" if b == "A" else "data_dict_b"] = {}
+            invalidar_indices()
+            raise ValueError(
+                f"Otro usuario ha guardado la base {' y '.join(cambiadas)} después de que se cargaran "
+                "sus datos. No se ha guardado nada: se recargará la última versión; repita los cambios."
+            )
+        return {b: escribir[b]() for b in bases}
+
+def registro_historial_b(df: pd.DataFrame, fila) -> dict:
+    """Fila de B con el estado actual de la fila 'fila' de una hoja A."""
+    def val(col, default=""):
+        return df.at[fila, col] if col in df.columns else default
+
+    return {
+        "Ref. Saturno": val("Ref. Saturno", 0),
+        "Ref. Fisher": val("Ref. Fisher"),
+        "Nombre producto": val("Nombre producto"),
+        "NºLote": val("NºLote"),
+        "Caducidad": val("Caducidad", pd.NaT),
+        "Fecha Pedida": val("Fecha Pedida", None),
+        "Fecha Llegada": val("Fecha Llegada", None),
+        "Sitio almacenaje": val("Sitio almacenaje"),
+        "Uds.": val("Uds.", 0),
+        "Stock": val("Stock", 0),
+        "Comentario": val("Comentario"),
+        "Fecha Registro B": datetime.datetime.now(),
+        "Usuario": st.session_state.get("username", "")
+    }
+
+# ---------------------------------------------------------------------------------
+# Índice de caducidades (todas las hojas A + histórico B)
+# ---------------------------------------------------------------------------------
+COLS_INDICE_CAD = ["Origen", "Panel", "Fila", "Ref. Fisher", "Nombre producto", "NºLote", "Caducidad", "Stock"]
+
+def _columna_texto(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    serie = df[col]
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        serie = serie.astype(object)
+    return serie.fillna("").astype(str).str.strip()
+
+def _indice_caducidad_vacio() -> pd.DataFrame:
+    """Índice sin filas pero con Caducidad datetime64 (las búsquedas y restas de fechas lo necesitan)."""
+    vacio = pd.DataFrame(columns=COLS_INDICE_CAD)
+    return vacio.astype({"Fila": "int64", "Caducidad": "datetime64[ns]", "Stock": "int64"})
+
+def filas_indice_caducidad(df: pd.DataFrame, origen: str, panel: str) -> pd.DataFrame:
+    """
+    Extrae de una hoja (A o B) los lotes con Caducidad válida en el formato del índice.
+    En B sólo se conserva el último registro de cada (Ref. Fisher, NºLote).
+    """
+    if df is None or df.empty or "Caducidad" not in df.columns:
+        return _indice_caducidad_vacio()
+
+    filas = pd.DataFrame({
+        "Origen": origen,
+        "Panel": panel,
+        "Fila": df.index,
+        "Ref. Fisher": _columna_texto(df, "Ref. Fisher").values,
+        "Nombre producto": _columna_texto(df, "Nombre producto").values,
+        "NºLote": _columna_texto(df, "NºLote").values,
+        "Caducidad": pd.to_datetime(df["Caducidad"], errors="coerce").values,
+        "Stock": (pd.to_numeric(df["Stock"], errors="coerce").fillna(0).astype(int).values
+                  if "Stock" in df.columns else 0),
+    })
+    filas = filas[filas["Caducidad"].notna()]
+
+    if origen == "B":
+        if "Fecha Registro B" in df.columns:
+            orden = pd.to_datetime(df["Fecha Registro B"], errors="coerce").values
+            filas = filas.assign(_orden=orden[filas.index]).sort_values("_orden", kind="mergesort")
+            filas = filas.drop(columns="_orden")
+        filas = filas.drop_duplicates(subset=["Ref. Fisher", "NºLote"], keep="last")
+    return filas
+
+def _ordenar_indice_caducidad(indice: pd.DataFrame) -> pd.DataFrame:
+    return indice.sort_values("Caducidad", kind="mergesort", ignore_index=True)
+
+def construir_indice_caducidad(dict_a: dict, dict_b: dict) -> pd.DataFrame:
+    """Construye el índice completo de caducidades ordenado por fecha."""
+    partes = [filas_indice_caducidad(df, "A", hoja) for hoja, df in dict_a.items()]
+    partes += [filas_indice_caducidad(df, "B", hoja) for hoja, df in dict_b.items()]
+    partes = [p for p in partes if not p.empty]
+    if not partes:
+        return _indice_caducidad_vacio()
+    return _ordenar_indice_caducidad(pd.concat(partes, ignore_index=True))
+
+def actualizar_indice_caducidad(indice: pd.DataFrame, origen: str, hoja: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Sustituye en el índice sólo las entradas de la hoja modificada."""
+    resto = indice[~((indice["Origen"] == origen) & (indice["Panel"] == hoja))]
+    nuevas = filas_indice_caducidad(df, origen, hoja)
+    partes = [p for p in (resto, nuevas) if not p.empty]
+    if not partes:
+        return _indice_caducidad_vacio()
+    return _ordenar_indice_caducidad(pd.concat(partes, ignore_index=True))
+
+def lotes_por_caducar(indice: pd.DataFrame, dias: int, incluir_caducados=True,
+                      incluir_historico=False) -> pd.DataFrame:
+    """
+    Devuelve los lotes que caducan en los próximos 'dias' días (búsqueda binaria sobre el índice).
+    Por defecto sólo los lotes actuales de A; con 'incluir_historico' se añaden los lotes que
+    sólo constan en B y cuyo último registro aún tenía stock.
+    """
+    hoy = pd.Timestamp(datetime.date.today())
+    if indice.empty:
+        return _indice_caducidad_vacio().assign(**{"Días restantes": pd.Series(dtype="int64")})
+    fechas = indice["Caducidad"].values
+    ini = 0 if incluir_caducados else np.searchsorted(fechas, np.datetime64(hoy), side="left")
+    fin = np.searchsorted(fechas, np.datetime64(hoy + pd.Timedelta(days=dias)), side="right")
+    res = indice.iloc[ini:fin]
+
+    es_a = res["Origen"] == "A"
+    if incluir_historico:
+        # Un lote presente en A prevalece sobre su registro histórico en B
+        clave = res["Ref. Fisher"] + "|" + res["NºLote"]
+        clave_a = (indice["Ref. Fisher"] + "|" + indice["NºLote"])[indice["Origen"] == "A"]
+        res = res[es_a | (~clave.isin(clave_a) & (res["Stock"] > 0))]
+    else:
+        res = res[es_a]
+
+    res = res.copy()
+    res["Días restantes"] = (res["Caducidad"] - hoy).dt.days
+    return res
+
+def _lotes_a_con_stock(indice: pd.DataFrame, ref_fisher: str) -> pd.DataFrame:
+    """
+    Lotes actuales (A) con stock del mismo Ref. Fisher en todos los paneles. Los lotes que
+    sólo constan en B son históricos (sustituidos o consumidos).
+    """
+    return indice[
+        (indice["Origen"] == "A") & (indice["Ref. Fisher"] == str(ref_fisher).strip())
+        & (indice["NºLote"] != "") & (indice["Stock"] > 0)
+    ]
+
+def sugerencia_fefo(indice: pd.DataFrame, ref_fisher: str) -> pd.DataFrame:
+    """Lotes con stock aún no caducados, primero el que antes caduca (sin fecha, al final)."""
+    cand = _lotes_a_con_stock(indice, ref_fisher)
+    hoy = pd.Timestamp(datetime.date.today())
+    return cand[~(cand["Caducidad"] < hoy)].sort_values("Caducidad", kind="mergesort")
+
+def lotes_caducados_con_stock(indice: pd.DataFrame, ref_fisher: str) -> pd.DataFrame:
+    """Lotes con stock cuya caducidad ya ha pasado (no deben usarse)."""
+    cand = _lotes_a_con_stock(indice, ref_fisher)
+    hoy = pd.Timestamp(datetime.date.today())
+    return cand[cand["Caducidad"] < hoy].sort_values("Caducidad", kind="mergesort")
+
+# ---------------------------------------------------------------------------------
+# Alarmas de stock (vectorizadas) y tabla materializada de todos los paneles
+# ---------------------------------------------------------------------------------
+COLS_TABLA_ALARMAS = ["Alarma", "Nombre producto", "Ref. Fisher", "NºLote", "Stock", "Fecha Pedida"]
+
+def calc_alarmas(df: pd.DataFrame) -> pd.Series:
+    """
+    Calcula la alarma de todas las filas a la vez:
+    🔴 sin stock y sin pedir, 🟨 sin stock pero ya pedido.
+    """
+    if "Stock" in df.columns:
+        sin_stock = pd.to_numeric(df["Stock"], errors="coerce").fillna(0).eq(0).to_numpy(dtype=bool)
+    else:
+        sin_stock = np.ones(len(df), dtype=bool)
+    if "Fecha Pedida" in df.columns:
+        pedido = pd.to_datetime(df["Fecha Pedida"], errors="coerce").notna().to_numpy(dtype=bool)
+    else:
+        pedido = np.zeros(len(df), dtype=bool)
+    alarmas = np.select([sin_stock & ~pedido, sin_stock & pedido], ["🔴", "🟨"], default="")
+    return pd.Series(alarmas, index=df.index, dtype=object)
+
+def filas_tabla_alarmas(df: pd.DataFrame, panel: str) -> pd.DataFrame:
+    """Devuelve sólo las filas con alarma, indexadas por (Panel, Fila)."""
+    if df is None or df.empty:
+        return pd.DataFrame(columns=COLS_TABLA_ALARMAS,
+                            index=pd.MultiIndex.from_arrays([[], []], names=["Panel", "Fila"]))
+    alarmas = calc_alarmas(df)
+    con_alarma = alarmas != ""
+    filas = pd.DataFrame({
+        "Alarma": alarmas[con_alarma],
+        "Nombre producto": _columna_texto(df, "Nombre producto")[con_alarma],
+        "Ref. Fisher": _columna_texto(df, "Ref. Fisher")[con_alarma],
+        "NºLote": _columna_texto(df, "NºLote")[con_alarma],
+        "Stock": (pd.to_numeric(df["Stock"], errors="coerce").fillna(0).astype(int)[con_alarma]
+                  if "Stock" in df.columns else 0),
+        "Fecha Pedida": (pd.to_datetime(df["Fecha Pedida"], errors="coerce")[con_alarma]
+                         if "Fecha Pedida" in df.columns else pd.NaT),
+    })
+    filas.index = pd.MultiIndex.from_arrays(
+        [[panel] * len(filas), filas.index], names=["Panel", "Fila"]
+    )
+    return filas
+
+def construir_tabla_alarmas(dict_a: dict) -> pd.DataFrame:
+    """Tabla de alarmas de todas las hojas de A."""
+    partes = [filas_tabla_alarmas(df, hoja) for hoja, df in dict_a.items()]
+    return pd.concat(partes) if partes else filas_tabla_alarmas(None, "")
+
+def actualizar_tabla_alarmas(tabla: pd.DataFrame, hoja: str, df: pd.DataFrame, filas=None) -> pd.DataFrame:
+    """
+    Recalcula las alarmas sólo de las filas tocadas ('filas') de la hoja indicada.
+    Si 'filas' es None se recalcula la hoja completa.
+    """
+    en_hoja = tabla.index.get_level_values("Panel") == hoja
+    if filas is None:
+        quitar = en_hoja
+        nuevas = filas_tabla_alarmas(df, hoja)
+    else:
+        filas = [f for f in dict.fromkeys(filas) if df is not None and f in df.index]
+        quitar = en_hoja & tabla.index.get_level_values("Fila").isin(filas)
+        nuevas = filas_tabla_alarmas(df.loc[filas], hoja)
+    partes = [p for p in (tabla[~quitar], nuevas) if not p.empty]
+    return pd.concat(partes) if partes else filas_tabla_alarmas(None, hoja)
+
+# ---------------------------------------------------------------------------------
+# Índice de reactivos compartidos entre paneles (por Ref. Fisher)
+# ---------------------------------------------------------------------------------
+COLS_RESUMEN_COMPARTIDOS = ["Nombre producto", "Stock total", "Pedidos pendientes", "Nº paneles", "Reparto por panel"]
+
+def aportes_por_panel(df: pd.DataFrame, panel: str) -> pd.DataFrame:
+    """
+    Stock, pedidos pendientes (Fecha Pedida sin Fecha Llegada posterior) y nº de filas
+    de cada Ref. Fisher en una hoja de A, indexado por (Ref. Fisher, Panel).
+    """
+    vacio = pd.DataFrame(
+        columns=["Nombre producto", "Stock", "Pendientes", "Filas"],
+        index=pd.MultiIndex.from_arrays([[], []], names=["Ref. Fisher", "Panel"])
+    )
+    if df is None or df.empty or "Ref. Fisher" not in df.columns:
+        return vacio
+
+    pedida = (pd.to_datetime(df["Fecha Pedida"], errors="coerce")
+              if "Fecha Pedida" in df.columns else pd.Series(pd.NaT, index=df.index))
+    llegada = (pd.to_datetime(df["Fecha Llegada"], errors="coerce")
+               if "Fecha Llegada" in df.columns else pd.Series(pd.NaT, index=df.index))
+    pendiente = pedida.notna() & (llegada.isna() | (llegada < pedida))
+
+    filas = pd.DataFrame({
+        "Ref. Fisher": _columna_texto(df, "Ref. Fisher").values,
+        "Nombre producto": _columna_texto(df, "Nombre producto").values,
+        "Stock": (pd.to_numeric(df["Stock"], errors="coerce").fillna(0).astype(int).values
+                  if "Stock" in df.columns else 0),
+        "Pendientes": pendiente.astype(int).values,
+    })
+    filas = filas[filas["Ref. Fisher"] != ""]
+    if filas.empty:
+        return vacio
+    grupos = filas.groupby("Ref. Fisher")
+    aportes = pd.DataFrame({
+        "Nombre producto": grupos["Nombre producto"].first(),
+        "Stock": grupos["Stock"].sum(),
+        "Pendientes": grupos["Pendientes"].sum(),
+        "Filas": grupos.size(),
+    })
+    aportes.index = pd.MultiIndex.from_arrays(
+        [aportes.index, [panel] * len(aportes)], names=["Ref. Fisher", "Panel"]
+    )
+    return aportes
+
+def resumir_compartidos(aportes: pd.DataFrame) -> pd.DataFrame:
+    """Agrega los aportes de todos los paneles en una fila por Ref. Fisher."""
+    if aportes.empty:
+        return pd.DataFrame(columns=COLS_RESUMEN_COMPARTIDOS, index=pd.Index([], name="Ref. Fisher"))
+    planos = aportes.reset_index().sort_values("Panel", kind="mergesort")
+    planos["Reparto"] = planos["Panel"] + ": " + planos["Stock"].astype(int).astype(str)
+    grupos = planos.groupby("Ref. Fisher")
+    return pd.DataFrame({
+        "Nombre producto": grupos["Nombre producto"].first(),
+        "Stock total": grupos["Stock"].sum().astype(int),
+        "Pedidos pendientes": grupos["Pendientes"].sum().astype(int),
+        "Nº paneles": grupos["Panel"].nunique(),
+        "Reparto por panel": grupos["Reparto"].agg(" · ".join),
+    })
+
+def construir_indice_compartidos(dict_a: dict) -> dict:
+    """Aportes por (Ref. Fisher, Panel) y su resumen por Ref. Fisher."""
+    partes = [aportes_por_panel(df, hoja) for hoja, df in dict_a.items()]
+    partes = [p for p in partes if not p.empty]
+    aportes = pd.concat(partes) if partes else aportes_por_panel(None, "")
+    return {"aportes": aportes, "resumen": resumir_compartidos(aportes)}
+
+def actualizar_indice_compartidos(indice: dict, hoja: str, df: pd.DataFrame) -> dict:
+    """Sustituye los aportes de la hoja y recalcula el resumen sólo de las Ref. Fisher afectadas."""
+    aportes = indice["aportes"]
+    en_hoja = aportes.index.get_level_values("Panel") == hoja
+    nuevos = aportes_por_panel(df, hoja)
+    afectadas = (set(aportes.index.get_level_values("Ref. Fisher")[en_hoja])
+                 | set(nuevos.index.get_level_values("Ref. Fisher")))
+
+    partes = [p for p in (aportes[~en_hoja], nuevos) if not p.empty]
+    aportes = pd.concat(partes) if partes else aportes_por_panel(None, "")
+
+    resumen = indice["resumen"]
+    resumen = resumen[~resumen.index.isin(afectadas)]
+    recalculado = resumir_compartidos(aportes[aportes.index.get_level_values("Ref. Fisher").isin(afectadas)])
+    partes = [p for p in (resumen, recalculado) if not p.empty]
+    resumen = pd.concat(partes) if partes else resumir_compartidos(aportes)
+    return {"aportes": aportes, "resumen": resumen}
+
+# ---------------------------------------------------------------------------------
+# Previsión de consumo y punto de pedido (a partir del histórico B)
+# ---------------------------------------------------------------------------------
+COLS_ESTADO_PREVISION = ["Consumo", "Primera fecha", "Última fecha", "Último stock", "Último plazo",
+                         "Última llegada", "Último lote"]
+COLS_MOVIMIENTOS = ["Hoja", "Ref. Fisher", "Fecha", "Stock", "Plazo", "Uds.", "Llegada", "Lote"]
+
+def _estado_prevision_vacio() -> pd.DataFrame:
+    return pd.DataFrame(
+        columns=COLS_ESTADO_PREVISION,
+        index=pd.MultiIndex.from_arrays([[], []], names=["Hoja", "Ref. Fisher"])
+    )
+
+def movimientos_b(df: pd.DataFrame, hoja: str) -> pd.DataFrame:
+    """
+    Normaliza una hoja B a registros (Hoja, Ref. Fisher, Fecha, Stock, Plazo, Uds., Llegada,
+    Lote) ordenados por fecha. Uds., Llegada y Lote permiten reconocer las entradas de stock.
+    """
+    if (df is None or df.empty or "Ref. Fisher" not in df.columns
+            or "Stock" not in df.columns or "Fecha Registro B" not in df.columns):
+        return pd.DataFrame(columns=COLS_MOVIMIENTOS)
+
+    if "Fecha Pedida" in df.columns and "Fecha Llegada" in df.columns:
+        plazo = (pd.to_datetime(df["Fecha Llegada"], errors="coerce")
+                 - pd.to_datetime(df["Fecha Pedida"], errors="coerce")).dt.total_seconds() / 86400
+        plazo = plazo.where(plazo >= 0)
+    else:
+        plazo = pd.Series(np.nan, index=df.index)
+
+    mov = pd.DataFrame({
+        "Hoja": hoja,
+        "Ref. Fisher": _columna_texto(df, "Ref. Fisher").values,
+        "Fecha": pd.to_datetime(df["Fecha Registro B"], errors="coerce").values,
+        "Stock": pd.to_numeric(df["Stock"], errors="coerce").fillna(0).astype(float).values,
+        "Plazo": plazo.values,
+        "Uds.": (pd.to_numeric(df["Uds."], errors="coerce").fillna(0).astype(float).values
+                 if "Uds." in df.columns else 0.0),
+        "Llegada": (pd.to_datetime(df["Fecha Llegada"], errors="coerce").values
+                    if "Fecha Llegada" in df.columns else pd.NaT),
+        "Lote": _columna_texto(df, "NºLote").values,
+    })
+    mov = mov[(mov["Ref. Fisher"] != "") & mov["Fecha"].notna()]
+    return mov.sort_values("Fecha", kind="mergesort")
+
+def _agregar_movimientos(mov: pd.DataFrame, estado: pd.DataFrame) -> pd.DataFrame:
+    """
+    Agrega registros nuevos de B al estado previo. El último registro conocido de cada
+    (Hoja, Ref. Fisher) se usa como semilla para que la primera diferencia sea correcta.
+
+    Consumo de cada registro = stock anterior + entrada - stock actual. Es una entrada
+    (se suman sus Uds.) el registro con nueva Fecha Llegada o con nuevo NºLote, igual que
+    al guardar en la hoja A; así el consumo sin registro en B (p. ej. 'Informar Reactivo
+    Agotado') no queda oculto por la llegada siguiente.
+    """
+    if mov.empty:
+        return estado
+
+    claves = pd.MultiIndex.from_frame(mov[["Hoja", "Ref. Fisher"]]).unique()
+    previas = estado[estado.index.isin(claves)]
+    semillas = pd.DataFrame({
+        "Hoja": previas.index.get_level_values("Hoja"),
+        "Ref. Fisher": previas.index.get_level_values("Ref. Fisher"),
+        "Fecha": previas["Última fecha"].values,
+        "Stock": previas["Último stock"].values.astype(float),
+        "Uds.": 0.0,
+        "Llegada": pd.to_datetime(previas["Última llegada"]).values,
+        "Lote": previas["Último lote"].values,
+        "_semilla": True,
+    })
+    # Sin semillas vacías ni columnas todo-NA: concat las trataría de otro modo en pandas futuros
+    partes = [p for p in (semillas, mov.assign(_semilla=False)) if not p.empty]
+    todo = pd.concat(partes, ignore_index=True)
+    todo = todo.sort_values(["Hoja", "Ref. Fisher"], kind="mergesort")
+
+    anterior = todo.groupby(["Hoja", "Ref. Fisher"])[["Stock", "Llegada", "Lote"]].shift()
+    es_entrada = (
+        (todo["Llegada"].notna() & (todo["Llegada"] != anterior["Llegada"]))
+        | ((todo["Lote"] != "") & (todo["Lote"] != anterior["Lote"]))
+    )
+    entrada = todo["Uds."].where(es_entrada, 0.0)
+    todo["Consumo"] = (anterior["Stock"] + entrada - todo["Stock"]).clip(lower=0).fillna(0)
+    nuevos = todo[~todo["_semilla"].astype(bool)]
+    grupos = nuevos.groupby(["Hoja", "Ref. Fisher"])
+    # last() saltaría los nulos: la llegada y el lote del último registro son tal cual
+    ultimos = nuevos.drop_duplicates(["Hoja", "Ref. Fisher"], keep="last").set_index(["Hoja", "Ref. Fisher"])
+    delta = pd.DataFrame({
+        "Consumo": grupos["Consumo"].sum(),
+        "Primera fecha": grupos["Fecha"].min(),
+        "Última fecha": grupos["Fecha"].max(),
+        "Último stock": grupos["Stock"].last(),
+        "Último plazo": grupos["Plazo"].last(),
+    })
+    delta["Última llegada"] = ultimos["Llegada"]
+    delta["Último lote"] = ultimos["Lote"]
+
+    comunes = delta.index.intersection(estado.index)
+    if len(comunes):
+        delta.loc[comunes, "Consumo"] += estado.loc[comunes, "Consumo"].astype(float)
+        delta.loc[comunes, "Primera fecha"] = estado.loc[comunes, "Primera fecha"]
+        delta.loc[comunes, "Último plazo"] = delta.loc[comunes, "Último plazo"].fillna(
+            estado.loc[comunes, "Último plazo"]
+        )
+    resto = estado[~estado.index.isin(delta.index)]
+    return pd.concat([resto, delta[COLS_ESTADO_PREVISION]]) if not resto.empty else delta[COLS_ESTADO_PREVISION]
+
+def construir_estado_prevision(dict_b: dict) -> dict:
+    """Estado agregado de consumo por (Hoja, Ref. Fisher) y nº de filas de B ya procesadas."""
+    estado = {"agregados": _estado_prevision_vacio(), "filas": {}}
+    for hoja, df in dict_b.items():
+        estado = actualizar_estado_prevision(estado, hoja, df)
+    return estado
+
+def actualizar_estado_prevision(estado: dict, hoja: str, df: pd.DataFrame) -> dict:
+    """
+    Procesa sólo las filas de B añadidas desde la última vez. Si la hoja ha perdido
+    filas (borrado en 'Informar Reactivo Agotado') se recalcula esa hoja completa.
+    """
+    agregados = estado["agregados"]
+    procesadas = estado["filas"].get(hoja, 0)
+    n_filas = 0 if df is None else len(df)
+
+    if n_filas < procesadas:
+        agregados = agregados[agregados.index.get_level_values("Hoja") != hoja]
+        procesadas = 0
+    if n_filas > procesadas:
+        agregados = _agregar_movimientos(movimientos_b(df.iloc[procesadas:], hoja), agregados)
+
+    filas = dict(estado["filas"])
+    filas[hoja] = n_filas
+    return {"agregados": agregados, "filas": filas}
+
+def calcular_prevision(agregados: pd.DataFrame, resumen_compartidos: pd.DataFrame) -> pd.DataFrame:
+    """
+    Por Ref. Fisher: consumo diario, días de stock restantes (con el stock actual de A)
+    y fecha sugerida de pedido descontando el último plazo de entrega observado.
+    """
+    hoy = pd.Timestamp(datetime.date.today())
+    if agregados.empty:
+        return pd.DataFrame(columns=["Ref. Fisher", "Nombre producto", "Stock actual", "Consumo diario",
+                                     "Días de stock", "Plazo entrega (días)", "Fecha pedido sugerida"])
+
+    dias = (pd.to_datetime(agregados["Última fecha"]) - pd.to_datetime(agregados["Primera fecha"])).dt.days
+    tasa = agregados["Consumo"].astype(float) / dias.clip(lower=1)
+    por_ref = pd.DataFrame({
+        "Consumo diario": tasa.groupby(level="Ref. Fisher").sum(),
+        "Plazo entrega (días)": agregados["Último plazo"].astype(float).groupby(level="Ref. Fisher").max(),
+    })
+    por_ref["Stock actual"] = resumen_compartidos["Stock total"].reindex(por_ref.index).fillna(0)
+    por_ref["Nombre producto"] = resumen_compartidos["Nombre producto"].reindex(por_ref.index).fillna("")
+
+    consumo = por_ref["Consumo diario"]
+    por_ref["Días de stock"] = (por_ref["Stock actual"] / consumo.where(consumo > 0)).round(1)
+    margen = (por_ref["Días de stock"] - por_ref["Plazo entrega (días)"].fillna(0)).clip(lower=0)
+    por_ref["Fecha pedido sugerida"] = hoy + pd.to_timedelta(np.floor(margen), unit="D")
+    por_ref["Consumo diario"] = consumo.round(3)
+    por_ref["Plazo entrega (días)"] = por_ref["Plazo entrega (días)"].round(1)
+
+    por_ref = por_ref.reset_index().sort_values("Fecha pedido sugerida", kind="mergesort", na_position="last")
+    return por_ref[["Ref. Fisher", "Nombre producto", "Stock actual", "Consumo diario",
+                    "Días de stock", "Plazo entrega (días)", "Fecha pedido sugerida"]]
+
+# ---------------------------------------------------------------------------------
+# Índice de búsqueda de reactivos (nombre, Ref. Fisher, Ref. Saturno, NºLote)
+# ---------------------------------------------------------------------------------
+CAMPOS_BUSQUEDA = ["Nombre producto", "Ref. Fisher", "Ref. Saturno", "NºLote"]
+
+def normalizar_busqueda(texto) -> str:
+    """Minúsculas y sin tildes, para comparar claves de búsqueda."""
+    texto = unicodedata.normalize("NFKD", str(texto).strip().lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+def etiquetas_reactivos(df: pd.DataFrame) -> pd.Series:
+    """Etiqueta 'Nombre producto (Ref. Fisher)' de cada fila, como en los selectores."""
+    if "Nombre producto" in df.columns and "Ref. Fisher" in df.columns:
+        return df["Nombre producto"].astype(str) + " (" + df["Ref. Fisher"].astype(str) + ")"
+    return df.iloc[:, 0].astype(str)
+
+def _entradas_busqueda(df: pd.DataFrame, panel: str) -> pd.DataFrame:
+    """Claves normalizadas (valor completo y cada palabra del nombre) -> fila de la hoja."""
+    partes = []
+    for campo in CAMPOS_BUSQUEDA:
+        if campo not in df.columns:
+            continue
+        valores = df[campo].astype(str).map(normalizar_busqueda)
+        if campo == "Ref. Saturno":
+            valores = valores.str.replace(r"\.0$", "", regex=True)
+        partes.append(pd.DataFrame({"Clave": valores.values, "Campo": campo, "Fila": df.index}))
+        if campo == "Nombre producto":
+            palabras = valores.str.split().explode()
+            partes.append(pd.DataFrame({"Clave": palabras.values, "Campo": "Palabra", "Fila": palabras.index}))
+    if not partes:
+        return pd.DataFrame(columns=["Clave", "Panel", "Campo", "Fila"])
+    entradas = pd.concat(partes, ignore_index=True)
+    # Nulos convertidos a texto: NaN/None y el <NA> de los enteros con nulos (Ref. Saturno Int32)
+    entradas = entradas[entradas["Clave"].notna() & ~entradas["Clave"].isin(["", "nan", "0", "none", "<na>", "nat"])]
+    entradas = entradas.drop_duplicates()
+    entradas.insert(1, "Panel", panel)
+    return entradas
+
+def _compilar_claves(entradas: pd.DataFrame) -> dict:
+    entradas = entradas.sort_values("Clave", kind="mergesort", ignore_index=True)
+    return {
+        "entradas": entradas,
+        "claves": entradas["Clave"].to_numpy(dtype=str),
+        "claves_unicas": entradas["Clave"].unique().tolist(),
+    }
+
+def _etiquetas_panel(df: pd.DataFrame) -> dict:
+    etiquetas = etiquetas_reactivos(df)
+    primera = etiquetas[~etiquetas.duplicated()]
+    return {
+        "fila_por_etiqueta": dict(zip(primera.values, primera.index)),
+        "etiqueta_por_fila": etiquetas.to_dict(),
+        "ordenadas": sorted(primera.values),
+    }
+
+def construir_indice_busqueda(dict_a: dict) -> dict:
+    """Índice de búsqueda de todas las hojas de A: claves ordenadas y etiquetas por panel."""
+    entradas = [_entradas_busqueda(df, hoja) for hoja, df in dict_a.items()]
+    entradas = [e for e in entradas if not e.empty]
+    indice = _compilar_claves(
+        pd.concat(entradas, ignore_index=True) if entradas else pd.DataFrame(columns=["Clave", "Panel", "Campo", "Fila"])
+    )
+    indice["paneles"] = {hoja: _etiquetas_panel(df) for hoja, df in dict_a.items()}
+    return indice
+
+def actualizar_indice_busqueda(indice: dict, hoja: str, df: pd.DataFrame) -> dict:
+    """Reindexa sólo la hoja guardada."""
+    entradas = indice["entradas"]
+    partes = [entradas[entradas["Panel"] != hoja]]
+    if df is not None:
+        partes.append(_entradas_busqueda(df, hoja))
+    partes = [p for p in partes if not p.empty]
+    nuevo = _compilar_claves(
+        pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(columns=["Clave", "Panel", "Campo", "Fila"])
+    )
+    nuevo["paneles"] = dict(indice["paneles"])
+    if df is not None:
+        nuevo["paneles"][hoja] = _etiquetas_panel(df)
+    else:
+        nuevo["paneles"].pop(hoja, None)
+    return nuevo
+
+def _filas_con_prefijo(indice: dict, prefijo: str) -> pd.DataFrame:
+    claves = indice["claves"]
+    ini = np.searchsorted(claves, prefijo, side="left")
+    fin = np.searchsorted(claves, prefijo + "\uffff", side="left")
+    return indice["entradas"].iloc[ini:fin]
+
+def buscar_reactivos(indice: dict, texto: str, panel=None) -> list:
+    """
+    Devuelve las posiciones (Panel, Fila) que casan con 'texto'.
+    Cada palabra se busca por prefijo y deben casar todas.
+    Si no hay resultados se prueba una búsqueda aproximada (difflib) sobre las claves.
+    """
+    palabras = normalizar_busqueda(texto).split()
+    if not palabras:
+        return []
+
+    def _buscar(palabra):
+        encontradas = _filas_con_prefijo(indice, palabra)
+        if encontradas.empty:
+            parecidas = difflib.get_close_matches(palabra, indice["claves_unicas"], n=5, cutoff=0.75)
+            encontradas = indice["entradas"][indice["entradas"]["Clave"].isin(parecidas)]
+        if panel is not None:
+            encontradas = encontradas[encontradas["Panel"] == panel]
+        return set(zip(encontradas["Panel"], encontradas["Fila"]))
+
+    resultado = _buscar(palabras[0])
+    for palabra in palabras[1:]:
+        if not resultado:
+            break
+        resultado &= _buscar(palabra)
+    return sorted(resultado, key=lambda pos: (str(pos[0]), pos[1]))
+
+def opciones_reactivo(indice: dict, panel: str, texto: str = "", ordenadas=False) -> list:
+    """Etiquetas del selector de un panel, filtradas por la búsqueda si la hay."""
+    etiquetas = indice["paneles"].get(panel, {"fila_por_etiqueta": {}, "etiqueta_por_fila": {}, "ordenadas": []})
+    if not texto.strip():
+        return etiquetas["ordenadas"] if ordenadas else list(etiquetas["fila_por_etiqueta"])
+    por_fila = etiquetas["etiqueta_por_fila"]
+    encontradas = dict.fromkeys(por_fila[f] for _, f in buscar_reactivos(indice, texto, panel=panel) if f in por_fila)
+    return sorted(encontradas) if ordenadas else list(encontradas)
+
+# ---------------------------------------------------------------------------------
+# Índice de auditoría sobre la base B (fecha, usuario, Ref. Fisher, NºLote)
+# ---------------------------------------------------------------------------------
+COLS_AUDITORIA = ["Fecha Registro B", "Usuario", "(Hoja B)", "Ref. Fisher", "Nombre producto", "NºLote", "Stock"]
+
+def _registros_auditoria(df: pd.DataFrame, hoja: str) -> pd.DataFrame:
+    if df is None or df.empty:
+        return pd.DataFrame(columns=COLS_AUDITORIA)
+    registros = df.copy()
+    registros["(Hoja B)"] = hoja
+    registros["Fecha Registro B"] = (pd.to_datetime(registros["Fecha Registro B"], errors="coerce")
+                                     if "Fecha Registro B" in registros.columns else pd.NaT)
+    for col in ["Usuario", "Ref. Fisher", "NºLote"]:
+        registros[col] = _columna_texto(registros, col)
+    return registros
+
+def _indexar_auditoria(registros: pd.DataFrame, filas: dict) -> dict:
+    """Ordena por fecha y crea las listas de posiciones por usuario, Ref. Fisher y NºLote."""
+    registros = registros.sort_values("Fecha Registro B", kind="mergesort", na_position="last", ignore_index=True)
+    return {
+        "registros": registros,
+        "fechas": registros["Fecha Registro B"].to_numpy(dtype="datetime64[ns]"),
+        "por_usuario": {k: np.asarray(v) for k, v in registros.groupby("Usuario").indices.items()},
+        "por_ref": {k: np.asarray(v) for k, v in registros.groupby("Ref. Fisher").indices.items()},
+        "por_lote": {k: np.asarray(v) for k, v in registros.groupby("NºLote").indices.items()},
+        "filas": filas,
+    }
+
+def construir_indice_auditoria(dict_b: dict) -> dict:
+    partes = [_registros_auditoria(df, hoja) for hoja, df in dict_b.items()]
+    partes = [p for p in partes if not p.empty]
+    registros = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(columns=COLS_AUDITORIA)
+    return _indexar_auditoria(registros, {hoja: len(df) for hoja, df in dict_b.items()})
+
+def actualizar_indice_auditoria(indice: dict, dict_b: dict, hoja: str) -> dict:
+    """
+    Añade al índice las filas nuevas de la hoja B. Si la hoja ha perdido filas o las
+    nuevas no son posteriores al último registro, se reconstruye el índice completo.
+    """
+    df = dict_b.get(hoja)
+    procesadas = indice["filas"].get(hoja, 0)
+    n_filas = 0 if df is None else len(df)
+    if n_filas <= procesadas:
+        return construir_indice_auditoria(dict_b) if n_filas < procesadas else indice
+
+    nuevas = _registros_auditoria(df.iloc[procesadas:], hoja)
+    nuevas = nuevas.sort_values("Fecha Registro B", kind="mergesort", ignore_index=True)
+    fechas_nuevas = nuevas["Fecha Registro B"].to_numpy(dtype="datetime64[ns]")
+    validas = indice["fechas"][~np.isnat(indice["fechas"])]
+    if (np.isnat(fechas_nuevas).any() or len(validas) < len(indice["fechas"])
+            or (len(validas) and fechas_nuevas[0] < validas[-1])):
+        return construir_indice_auditoria(dict_b)
+
+    base = len(indice["registros"])
+    nuevo = {
+        "registros": pd.concat([indice["registros"], nuevas], ignore_index=True),
+        "fechas": np.concatenate([indice["fechas"], fechas_nuevas]),
+        "filas": {**indice["filas"], hoja: n_filas},
+    }
+    for clave, col in [("por_usuario", "Usuario"), ("por_ref", "Ref. Fisher"), ("por_lote", "NºLote")]:
+        posiciones = dict(indice[clave])
+        for valor, pos in nuevas.groupby(col).indices.items():
+            previas = posiciones.get(valor, np.array([], dtype=np.intp))
+            posiciones[valor] = np.concatenate([previas, np.asarray(pos) + base])
+        nuevo[clave] = posiciones
+    return nuevo
+
+def consultar_auditoria(indice: dict, desde=None, hasta=None, usuario=None, ref_fisher=None, lote=None) -> np.ndarray:
+    """
+    Devuelve las posiciones (en orden cronológico) de los registros de B que cumplen
+    todos los filtros indicados. Las fechas se resuelven por búsqueda binaria.
+    """
+    fechas = indice["fechas"]
+    ini, fin = 0, len(fechas)
+    if desde is not None:
+        ini = np.searchsorted(fechas, np.datetime64(pd.Timestamp(desde), "ns"), side="left")
+    if hasta is not None:
+        fin = np.searchsorted(fechas, np.datetime64(pd.Timestamp(hasta), "ns"), side="left")
+    if desde is not None or hasta is not None:
+        fin = min(fin, len(fechas) - int(np.isnat(fechas).sum()))
+    posiciones = np.arange(ini, max(ini, fin))
+
+    for clave, valor in [("por_usuario", usuario), ("por_ref", ref_fisher), ("por_lote", lote)]:
+        if valor is None or str(valor).strip() == "":
+            continue
+        coincidencias = indice[clave].get(str(valor).strip(), np.array([], dtype=np.intp))
+        posiciones = np.intersect1d(posiciones, coincidencias, assume_unique=True)
+    return posiciones
+
+# ---------------------------------------------------------------------------------
+# Entrada rápida por escáner: resolución de códigos y aplicación por lotes
+# ---------------------------------------------------------------------------------
+def resolver_codigo(indice: dict, codigo: str, panel: str = None) -> list:
+    """
+    Posiciones (Panel, Fila) cuyo NºLote coincide exactamente con el código escaneado;
+    si ningún lote coincide se prueba con la Ref. Fisher. 'panel' limita la búsqueda.
+    """
+    clave = normalizar_busqueda(codigo)
+    if not clave:
+        return []
+    encontradas = _filas_con_prefijo(indice, clave)
+    encontradas = encontradas[encontradas["Clave"] == clave]
+    if panel:
+        encontradas = encontradas[encontradas["Panel"] == panel]
+    for campo in ("NºLote", "Ref. Fisher"):
+        por_campo = encontradas[encontradas["Campo"] == campo]
+        if not por_campo.empty:
+            return list(dict.fromkeys(zip(por_campo["Panel"], por_campo["Fila"])))
+    return []
+
+def reubicar_pendientes(pendientes: list) -> tuple:
+    """
+    Vuelve a localizar cada movimiento pendiente por su NºLote y Ref. Fisher en los datos
+    actuales (tras recargar, la fila puede haber cambiado o el lote ya no estar).
+    Devuelve (movimientos con la fila actual, movimientos descartados).
+    """
+    validos, descartados = [], []
+    for mov in pendientes:
+        df = st.session_state["data_dict"].get(mov["Panel"])
+        if df is None:
+            descartados.append(mov)
+            continue
+        coinciden = df.index[
+            (_columna_texto(df, "NºLote") == mov["NºLote"]).to_numpy(dtype=bool)
+            & (_columna_texto(df, "Ref. Fisher") == mov["Ref. Fisher"]).to_numpy(dtype=bool)
+        ]
+        if mov["Fila"] in coinciden:
+            validos.append(mov)
+        elif len(coinciden) == 1:
+            validos.append({**mov, "Fila": coinciden[0]})
+        else:
+            descartados.append(mov)
+    return validos, descartados
+
+def aplicar_movimientos(movimientos: list) -> dict:
+    """
+    Aplica a A los movimientos pendientes agrupados por hoja y fila (una sola escritura
+    por hoja), añade a B un registro por fila tocada y devuelve {hoja: [filas]}.
+    """
+    zona_local = pytz.timezone("Europe/Madrid")
+    ahora = pd.Timestamp(datetime.datetime.now(zona_local).replace(tzinfo=None)).floor("s")
+    mov = pd.DataFrame(movimientos)
+    mov["Delta"] = np.where(mov["Movimiento"] == "Entrada", mov["Uds."], -mov["Uds."])
+
+    tocadas = {}
+    for hoja, grupo in mov.groupby("Panel", sort=False):
+        df = enforce_types(st.session_state["data_dict"][hoja].copy())
+        deltas = grupo.groupby("Fila", sort=False)["Delta"].sum()
+        filas = deltas.index
+
+        if "Stock" in df.columns:
+            df.loc[filas, "Stock"] = (df.loc[filas, "Stock"] + deltas.values).clip(lower=0)
+        llegadas = grupo.loc[grupo["Movimiento"] == "Entrada", "Fila"].unique()
+        if len(llegadas) and "Fecha Llegada" in df.columns:
+            df.loc[llegadas, "Fecha Llegada"] = ahora
+
+        # Igual que en 'Informar Reactivo Agotado': sin stock se vacían los datos del lote
+        if "Stock" in df.columns:
+            agotadas = filas[df.loc[filas, "Stock"].eq(0).to_numpy(dtype=bool)]
+            for col_vaciar in ["NºLote", "Caducidad", "Fecha Pedida", "Fecha Llegada", "Sitio almacenaje"]:
+                if col_vaciar in df.columns and len(agotadas):
+                    if col_vaciar in ["Caducidad", "Fecha Pedida", "Fecha Llegada"]:
+                        df.loc[agotadas, col_vaciar] = pd.NaT
+                    else:
+                        df.loc[agotadas, col_vaciar] = ""
+        st.session_state["data_dict"][hoja] = df
+
+        df_b = st.session_state["data_dict_b"].get(hoja, pd.DataFrame())
+        nuevas_b = pd.DataFrame([registro_historial_b(df, fila) for fila in filas])
+        # En B, las Uds. de una entrada escaneada son las recibidas (no las Uds. por pedido de A)
+        recibidas = grupo[grupo["Movimiento"] == "Entrada"].groupby("Fila")["Uds."].sum()
+        if len(recibidas):
+            nuevas_b["Uds."] = pd.Series(filas).map(recibidas).fillna(nuevas_b["Uds."]).values
+        st.session_state["data_dict_b"][hoja] = compactar_tipos(pd.concat([df_b, nuevas_b], ignore_index=True))
+        tocadas[hoja] = list(filas)
+    return tocadas
+
+def notificar_cambio(origen: str, hoja: str, filas=None):
+    """
+    Actualiza los índices derivados tras guardar una hoja de A ('A') o de B ('B').
+    'filas' limita el recálculo a las filas modificadas cuando el índice lo permite.
+    """
+    datos = st.session_state["data_dict"] if origen == "A" else st.session_state["data_dict_b"]
+    df = datos.get(hoja)
+    if "indice_caducidad" in st.session_state:
+        st.session_state["indice_caducidad"] = actualizar_indice_caducidad(
+            st.session_state["indice_caducidad"], origen, hoja, df
+        )
+    if origen == "A" and "tabla_alarmas" in st.session_state:
+        st.session_state["tabla_alarmas"] = actualizar_tabla_alarmas(
+            st.session_state["tabla_alarmas"], hoja, df, filas
+        )
+    if origen == "A" and "indice_compartidos" in st.session_state:
+        st.session_state["indice_compartidos"] = actualizar_indice_compartidos(
+            st.session_state["indice_compartidos"], hoja, df
+        )
+    if origen == "A" and "indice_busqueda" in st.session_state:
+        st.session_state["indice_busqueda"] = actualizar_indice_busqueda(
+            st.session_state["indice_busqueda"], hoja, df
+        )
+    if origen == "B" and "estado_prevision" in st.session_state:
+        st.session_state["estado_prevision"] = actualizar_estado_prevision(
+            st.session_state["estado_prevision"], hoja, df
+        )
+    if origen == "B" and "indice_auditoria" in st.session_state:
+        st.session_state["indice_auditoria"] = actualizar_indice_auditoria(
+            st.session_state["indice_auditoria"], st.session_state["data_dict_b"], hoja
+        )
+        st.session_state.pop("aud_export", None)
+    st.session_state.pop("prevision_consumo", None)
+
 # ---------------------------------------------------------------------------------
 # Verificamos si hay datos en session_state, si no => app no puede continuar
 # ---------------------------------------------------------------------------------
+# Guardado rechazado en la ejecución anterior (los datos ya se han recargado)
+if "aviso_guardado" in st.session_state:
+    st.error(st.session_state.pop("aviso_guardado"))
+
 if not st.session_state["data_dict"]:
     st.warning("No se ha cargado ninguna base A. Sube un archivo en la barra lateral para continuar.")
     st.stop()
@@ -419,100 +1770,138 @@ if not st.session_state["data_dict_b"]:
 data_dict = st.session_state["data_dict"]
 data_dict_b = st.session_state["data_dict_b"]
 
+if "indice_caducidad" not in st.session_state:
+    st.session_state["indice_caducidad"] = construir_indice_caducidad(data_dict, data_dict_b)
+if "tabla_alarmas" not in st.session_state:
+    st.session_state["tabla_alarmas"] = construir_tabla_alarmas(data_dict)
+if "indice_compartidos" not in st.session_state:
+    st.session_state["indice_compartidos"] = construir_indice_compartidos(data_dict)
+if "indice_busqueda" not in st.session_state:
+    st.session_state["indice_busqueda"] = construir_indice_busqueda(data_dict)
+if "estado_prevision" not in st.session_state:
+    st.session_state["estado_prevision"] = construir_estado_prevision(data_dict_b)
+if "indice_auditoria" not in st.session_state:
+    st.session_state["indice_auditoria"] = construir_indice_auditoria(data_dict_b)
+
+# Informe de memoria de los datos de esta sesión (esquema compacto frente a str/int64)
+with st.sidebar.expander("Uso de memoria (sesión)", expanded=False):
+    if st.button("Calcular uso de memoria", key="btn_memoria"):
+        df_memoria = pd.concat(
+            [informe_memoria(data_dict, "A"), informe_memoria(data_dict_b, "B")], ignore_index=True
+        )
+        antes_kb = df_memoria["Antes (KB)"].sum()
+        ahora_kb = df_memoria["Ahora (KB)"].sum()
+        st.metric("Memoria de datos (KB)", f"{ahora_kb:,.1f}", f"{ahora_kb - antes_kb:,.1f} KB", delta_color="inverse")
+        st.dataframe(df_memoria, hide_index=True)
+
 # -------------------------------------------------------------------------
-# Lógica de configuración de Lotes (colores, etc.)
+# Catálogo de paneles y lotes (catalogo.json, recargado al modificarse)
 # -------------------------------------------------------------------------
-LOTS_DATA = {
-    "FOCUS": {
-        "Panel Oncomine Focus Library Assay Chef Ready": [
-            "Primers DNA", "Primers RNA", "Reagents DL8", "Chef supplies (plásticos)", "Placas", "Solutions DL8"
-        ],
-        "Ion 510/520/530 kit-Chef (TEMPLADO)": [
-            "Chef Reagents", "Chef Solutions", "Chef supplies (plásticos)", "Solutions Reagent S5", "Botellas S5"
-        ],
-        "Recover All TM Multi-Sample RNA/DNA Isolation workflow-Kit": [
-            "Kit extracción DNA/RNA", "RecoverAll TM kit (Dnase, protease,…)", "H2O RNA free",
-            "Tubos fondo cónico", "Superscript VILO cDNA Syntheis Kit", "Qubit 1x dsDNA HS Assay kit (100 reactions)"
-        ],
-        "Chip secuenciación liberación de protones 6 millones de lecturas": []
-    },
-    "OCA": {
-        "Panel OCA Library Assay Chef Ready": [
-            "Primers DNA", "Primers RNA", "Reagents DL8", "Chef supplies (plásticos)", "Placas", "Solutions DL8"
-        ],
-        "kit-Chef (TEMPLADO)": [
-            "Ion 540 TM Chef Reagents", "Chef Solutions", "Chef supplies (plásticos)",
-            "Solutions Reagent S5", "Botellas S5"
-        ],
-        "Chip secuenciación liberación de protones 6 millones de lecturas": [
-            "Ion 540 TM Chip Kit"
-        ],
-        "Recover All TM Multi-Sample RNA/DNA Isolation workflow-Kit": [
-            "Kit extracción DNA/RNA", "RecoverAll TM kit (Dnase, protease,…)", "H2O RNA free", "Tubos fondo cónico"
-        ]
-    },
-    "OCA PLUS": {
-        "Panel OCA-PLUS Library Assay Chef Ready": [
-            "Primers DNA", "Uracil-DNA Glycosylase heat-labile", "Reagents DL8",
-            "Chef supplies (plásticos)", "Placas", "Solutions DL8"
-        ],
-        "kit-Chef (TEMPLADO)": [
-            "Ion 550 TM Chef Reagents", "Chef Solutions", "Chef Supplies (plásticos)",
-            "Solutions Reagent S5", "Botellas S5", "Chip secuenciación Ion 550 TM Chip Kit"
-        ],
-        "Recover All TM Multi-Sample RNA/DNA Isolation workflow-Kit": [
-            "Kit extracción DNA/RNA", "RecoverAll TM kit (Dnase, protease,…)", "H2O RNA free", "Tubos fondo cónico"
-        ]
+# Cada laboratorio puede tener su propio catalogo.json en su carpeta; si no, se usa el general
+ARCHIVO_CATALOGO = "catalogo.json"
+
+def ruta_catalogo() -> str:
+    propio = os.path.join(RAIZ_PARTICION, ARCHIVO_CATALOGO)
+    if PARTICION != PARTICION_PRINCIPAL and os.path.exists(propio):
+        return propio
+    if os.environ.get("STOCK_CATALOGO"):
+        return os.environ["STOCK_CATALOGO"]
+    ruta = resource_path(ARCHIVO_CATALOGO)
+    if not os.path.exists(ruta):
+        # Arrancada desde otra carpeta: el catálogo está junto al script
+        ruta = os.path.join(os.path.dirname(os.path.abspath(__file__)), ARCHIVO_CATALOGO)
+    return ruta
+
+@st.cache_resource(max_entries=8)
+def _compilar_catalogo(ruta: str, mtime_ns: int) -> dict:
+    """
+    Lee catalogo.json y precalcula las búsquedas que usa la vista. Se compila una
+    vez por versión del archivo (mtime_ns forma parte de la clave de la caché).
+    """
+    with open(ruta, "r", encoding="utf-8") as f:
+        datos = json.load(f)
+    validar_catalogo(datos)
+
+    lotes = datos.get("lotes", {})
+    paneles = list(datos.get("paneles", []))
+    paneles += [p for p in lotes if p not in paneles]
+    return {
+        "paneles": tuple(paneles),
+        # Títulos de grupo (nombre de kit) en minúsculas, por panel
+        "titulos": {panel: frozenset(k.strip().lower() for k in kits) for panel, kits in lotes.items()},
+        "limitantes": frozenset(str(r).strip() for r in datos.get("limitantes", [])),
+        "colores": tuple(datos.get("colores", ())) or ("#FFFFFF",),
     }
-}
-
-panel_order = ["FOCUS","OCA","OCA PLUS"]
 
-colors = [
-    "#FED7D7", "#FEE2E2", "#FFEDD5", "#FEF9C3", "#D9F99D",
-    "#CFFAFE", "#E0E7FF", "#FBCFE8", "#F9A8D4", "#E9D5FF",
-    "#FFD700", "#F0FFF0", "#D1FAE5", "#BAFEE2", "#A7F3D0", "#FFEC99"
-]
+def validar_catalogo(datos):
+    """Comprueba la estructura de catalogo.json; lanza ValueError con el primer error."""
+    def lista_de(valor, tipos) -> bool:
+        return isinstance(valor, list) and all(isinstance(v, tipos) for v in valor)
+
+    if not isinstance(datos, dict):
+        raise ValueError("el catálogo debe ser un objeto JSON")
+    if not lista_de(datos.get("paneles", []), str):
+        raise ValueError("'paneles' debe ser una lista de nombres")
+    lotes = datos.get("lotes", {})
+    if not isinstance(lotes, dict) or not all(
+        isinstance(kits, dict) and all(lista_de(comp, str) for comp in kits.values())
+        for kits in lotes.values()
+    ):
+        raise ValueError("'lotes' debe ser {panel: {kit: [componentes]}}")
+    if not lista_de(datos.get("limitantes", []), (str, int)):
+        raise ValueError("'limitantes' debe ser una lista de Ref. Fisher")
+    if not lista_de(datos.get("colores", []), str):
+        raise ValueError("'colores' debe ser una lista de colores ('#RRGGBB')")
+
+@st.cache_resource
+def _catalogos_validos() -> dict:
+    """Último catálogo compilado sin errores por ruta (se usa si el archivo se rompe al editarlo)."""
+    return {}
+
+def cargar_catalogo() -> dict:
+    ruta = ruta_catalogo()
+    try:
+        catalogo = _compilar_catalogo(ruta, os.stat(ruta).st_mtime_ns)
+    except (OSError, ValueError) as e:
+        previo = _catalogos_validos().get(ruta)
+        if previo is None:
+            st.error(f"No se pudo cargar el catálogo de paneles '{ruta}': {e}")
+            st.stop()
+        st.warning(f"El catálogo '{ruta}' tiene errores ({e}); se usa la última versión válida.")
+        return previo
+    _catalogos_validos()[ruta] = catalogo
+    return catalogo
+
+def color_grupo(catalogo: dict, gid) -> str:
+    """Color fijo por grupo: no cambia al añadir o quitar otros grupos del panel."""
+    colores = catalogo["colores"]
+    return colores[zlib.crc32(str(gid).encode("utf-8")) % len(colores)]
+
+def ordenar_paneles(hojas, catalogo: dict) -> list:
+    """Hojas en el orden del catálogo; las que no figuran en él, al final en su orden original."""
+    orden = {p: i for i, p in enumerate(catalogo["paneles"])}
+    return sorted(hojas, key=lambda h: orden.get(h, len(orden)))
+
+catalogo = cargar_catalogo()
 
 def build_group_info_by_ref(df: pd.DataFrame, panel_default=None):
     df = df.copy()
     df["GroupID"] = df["Ref. Saturno"]
-    group_sizes = df.groupby("GroupID").size().to_dict()
-    df["GroupCount"] = df["GroupID"].apply(lambda x: group_sizes.get(x, 0))
-
-    unique_ids = sorted(df["GroupID"].unique())
-    color_cycle_local = itertools.cycle(colors)
-    group_color_map = {}
-    for gid in unique_ids:
-        group_color_map[gid] = next(color_cycle_local)
-    df["ColorGroup"] = df["GroupID"].apply(lambda x: group_color_map.get(x, "#FFFFFF"))
-
-    group_titles = []
-    if panel_default in LOTS_DATA:
-        group_titles = [t.strip().lower() for t in LOTS_DATA[panel_default].keys()]
-
-    df["EsTitulo"] = False
-    for gid, group_df in df.groupby("GroupID"):
-        mask = group_df["Nombre producto"].str.strip().str.lower().isin(group_titles)
-        if mask.any():
-            idxs = group_df[mask].index
-            df.loc[idxs, "EsTitulo"] = True
-        else:
-            first_idx = group_df.index[0]
-            df.at[first_idx, "EsTitulo"] = True
+    df["GroupCount"] = df.groupby("GroupID")["GroupID"].transform("size")
 
-    df["MultiSort"] = df["GroupCount"].apply(lambda x: 0 if x > 1 else 1)
-    df["NotTitulo"] = df["EsTitulo"].apply(lambda x: 0 if x else 1)
-    return df
+    colores_grupo = {gid: color_grupo(catalogo, gid) for gid in df["GroupID"].unique()}
+    df["ColorGroup"] = df["GroupID"].map(colores_grupo).fillna("#FFFFFF")
 
-def calc_alarma(row):
-    s = row.get("Stock", 0)
-    fp = row.get("Fecha Pedida", None)
-    if s == 0 and pd.isna(fp):
-        return "🔴"
-    elif s == 0 and not pd.isna(fp):
-        return "🟨"
-    return ""
+    # Título: filas cuyo nombre es un kit del panel; si el grupo no tiene ninguna, su primera fila
+    group_titles = catalogo["titulos"].get(panel_default, frozenset())
+    es_kit = _columna_texto(df, "Nombre producto").str.lower().isin(group_titles)
+    grupo_con_kit = es_kit.groupby(df["GroupID"]).transform("any")
+    primera_del_grupo = ~df["GroupID"].duplicated()
+    df["EsTitulo"] = es_kit | (~grupo_con_kit & primera_del_grupo)
+
+    df["MultiSort"] = (df["GroupCount"] <= 1).astype(int)
+    df["NotTitulo"] = (~df["EsTitulo"]).astype(int)
+    return df
 
 def style_lote(row):
     bg = row.get("ColorGroup", "")
@@ -544,17 +1933,17 @@ st.divider()
 # -------------------------------------------------------------------------
 st.header("Gestión del Stock (Base A)")
 
-hojas_principales = list(data_dict.keys())
+hojas_principales = ordenar_paneles(data_dict.keys(), catalogo)
 sheet_name = st.selectbox("Seleccione el panel:", hojas_principales, key="main_sheet_sel")
 
 df_main_original = data_dict[sheet_name].copy()
 df_main_original = enforce_types(df_main_original)
 
 df_for_style = df_main_original.copy()
-df_for_style["Alarma"] = df_for_style.apply(calc_alarma, axis=1)
+df_for_style["Alarma"] = calc_alarmas(df_for_style)
 df_for_style = build_group_info_by_ref(df_for_style, panel_default=sheet_name)
 df_for_style.sort_values(by=["MultiSort", "GroupID", "NotTitulo"], inplace=True)
-df_for_style.reset_index(drop=True, inplace=True)
+# Se conservan las etiquetas de fila originales: identifican la fila en los índices derivados
 styled_df = df_for_style.style.apply(style_lote, axis=1)
 
 all_cols = df_for_style.columns.tolist()
@@ -568,14 +1957,18 @@ df_main.drop(columns=cols_to_hide, inplace=True, errors="ignore")
 st.write(f"#### Stock del Panel: {sheet_name}")
 st.write(table_html, unsafe_allow_html=True)
 
-# Selección de reactivo a modificar
-if "Nombre producto" in df_main.columns and "Ref. Fisher" in df_main.columns:
-    display_series = df_main.apply(lambda r: f"{r['Nombre producto']} ({r['Ref. Fisher']})", axis=1)
-else:
-    display_series = df_main.iloc[:, 0].astype(str)
+# Selección de reactivo a modificar (etiquetas y filas salen del índice de búsqueda)
+indice_busqueda = st.session_state["indice_busqueda"]
+texto_busqueda = st.text_input(
+    "Buscar reactivo (nombre, Ref. Fisher, Ref. Saturno o NºLote):", key="busqueda_modif"
+)
+opciones_modif = opciones_reactivo(indice_busqueda, sheet_name, texto_busqueda)
+if not opciones_modif:
+    st.warning("Ningún reactivo de este panel coincide con la búsqueda.")
+    opciones_modif = opciones_reactivo(indice_busqueda, sheet_name)
 
-reactivo_sel = st.selectbox("Seleccione Reactivo a Modificar:", display_series.unique(), key="react_modif")
-row_index = display_series[display_series == reactivo_sel].index[0]
+reactivo_sel = st.selectbox("Seleccione Reactivo a Modificar:", opciones_modif, key="react_modif")
+row_index = indice_busqueda["paneles"][sheet_name]["fila_por_etiqueta"][reactivo_sel]
 
 st.write("**No es necesario ingresar 'Fecha Pedida' si se ingresa 'Fecha Llegada', y viceversa.**")
 
@@ -678,7 +2071,7 @@ if st.button("Guardar Cambios en Hoja Stock"):
     if "NºLote" in df_main.columns:
         df_main.at[row_index, "NºLote"] = lote_new
     if "Caducidad" in df_main.columns:
-        df_main.at[row_index, "Caducidad"] = cad_new if cad_new else pd.NaT
+        df_main.at[row_index, "Caducidad"] = pd.Timestamp(cad_new) if cad_new else pd.NaT
     if "Fecha Pedida" in df_main.columns:
         df_main.at[row_index, "Fecha Pedida"] = fped_new_str
     if "Fecha Llegada" in df_main.columns:
@@ -691,6 +2084,7 @@ if st.button("Guardar Cambios en Hoja Stock"):
     df_main.at[row_index, "Comentario"] = comentario_nuevo
 
     # Actualizar fecha pedida en todos los reactivos del grupo
+    filas_tocadas = [row_index]
     if fped_new_str:
         if not group_order_selected:
             group_order_selected = options
@@ -698,50 +2092,32 @@ if st.button("Guardar Cambios en Hoja Stock"):
             try:
                 i_val = int(label.split(" - ")[0])
                 df_main.at[i_val, "Fecha Pedida"] = fped_new_str
+                filas_tocadas.append(i_val)
             except Exception as e:
                 st.error(f"Error actualizando índice {label}: {e}")
 
     st.session_state["data_dict"][sheet_name] = df_main
-
-    # Crear nueva versión en local (A)
-    new_file_a = crear_nueva_version_filename(VERSIONS_DIR, prefix="StockA")
-    with pd.ExcelWriter(new_file_a, engine="openpyxl") as writer:
-        for sht, df_sht in st.session_state["data_dict"].items():
-            ocultar_cols = ["ColorGroup","EsTitulo","GroupCount","MultiSort","NotTitulo","GroupID","Alarma"]
-            tmp = df_sht.drop(columns=ocultar_cols, errors="ignore")
-            tmp.to_excel(writer, sheet_name=sht, index=False)
-
-    st.success(f"✅ Cambios guardados en la nueva versión A: {new_file_a}")
+    notificar_cambio("A", sheet_name, filas=filas_tocadas)
 
     # Registrar también en la base B
-    if "data_dict_b" in st.session_state:
-        if sheet_name not in st.session_state["data_dict_b"]:
-            st.session_state["data_dict_b"][sheet_name] = pd.DataFrame()
-
-        df_b_sh = st.session_state["data_dict_b"][sheet_name].copy()
-        nueva_fila = {
-            "Ref. Saturno": df_main.at[row_index, "Ref. Saturno"] if "Ref. Saturno" in df_main.columns else 0,
-            "Ref. Fisher": df_main.at[row_index, "Ref. Fisher"] if "Ref. Fisher" in df_main.columns else "",
-            "Nombre producto": df_main.at[row_index, "Nombre producto"] if "Nombre producto" in df_main.columns else "",
-            "NºLote": df_main.at[row_index, "NºLote"],
-            "Caducidad": df_main.at[row_index, "Caducidad"],
-            "Fecha Pedida": df_main.at[row_index, "Fecha Pedida"],
-            "Fecha Llegada": df_main.at[row_index, "Fecha Llegada"],
-            "Sitio almacenaje": df_main.at[row_index, "Sitio almacenaje"],
-            "Uds.": df_main.at[row_index, "Uds."] if "Uds." in df_main.columns else 0,
-            "Stock": df_main.at[row_index, "Stock"] if "Stock" in df_main.columns else 0,
-            "Comentario": df_main.at[row_index, "Comentario"] if "Comentario" in df_main.columns else "",
-            "Fecha Registro B": datetime.datetime.now()
-        }
-        df_b_sh = pd.concat([df_b_sh, pd.DataFrame([nueva_fila])], ignore_index=True)
-        st.session_state["data_dict_b"][sheet_name] = df_b_sh
+    if sheet_name not in st.session_state["data_dict_b"]:
+        st.session_state["data_dict_b"][sheet_name] = pd.DataFrame()
+
+    df_b_sh = st.session_state["data_dict_b"][sheet_name].copy()
+    nueva_fila = registro_historial_b(df_main, row_index)
+    df_b_sh = compactar_tipos(pd.concat([df_b_sh, pd.DataFrame([nueva_fila])], ignore_index=True))
+    st.session_state["data_dict_b"][sheet_name] = df_b_sh
+    notificar_cambio("B", sheet_name)
 
-        new_file_b = crear_nueva_version_filename(VERSIONS_DIR_B, prefix="StockB")
-        with pd.ExcelWriter(new_file_b, engine="openpyxl") as writer_b:
-            for shtB, df_shtB in st.session_state["data_dict_b"].items():
-                df_shtB.to_excel(writer_b, sheet_name=shtB, index=False)
+    # Crear nuevas versiones en local (A y B, con un único bloqueo)
+    try:
+        rutas = guardar_versiones("A", "B")
+    except ValueError as e:
+        st.session_state["aviso_guardado"] = str(e)
+        st.rerun()
 
-        st.success(f"✅ Registro agregado también en la base B => {new_file_b}")
+    st.success(f"✅ Cambios guardados en la nueva versión A: {rutas['A']}")
+    st.success(f"✅ Registro agregado también en la base B => {rutas['B']}")
 
     excel_bytes = generar_excel_en_memoria(df_main, sheet_nm=sheet_name)
     st.download_button(
@@ -763,7 +2139,12 @@ st.divider()
 tabs = st.tabs([
     "Ver Base de Datos Historial (B)",
     "Filtrar Reactivos Limitantes/Compartidos",
-    "Informar Reactivo Agotado"
+    "Informar Reactivo Agotado",
+    "Caducidades Próximas",
+    "Alarmas (Todos los Paneles)",
+    "Previsión de Consumo",
+    "Auditoría (B)",
+    "Entrada Rápida (Escáner)"
 ])
 
 # ---------------------- TAB 1: Ver Base B ----------------------
@@ -794,11 +2175,7 @@ with tabs[1]:
         st.warning("No hay datos en base B. Sube un archivo B en la barra lateral o registra cambios.")
         st.stop()
 
-    limitantes_set = {
-        "A42006","A42007","A27762","A34018","A33638","A33639","A27758","A27765","A4517",
-        "A3410","A34537","A45617","A34540","A36410","A29025","A29027","A29026","A27754",
-        "11754050","11766050"
-    }
+    limitantes_set = catalogo["limitantes"]
 
     all_rows_b = []
     for sheet_b, df_b_sht in st.session_state["data_dict_b"].items():
@@ -863,6 +2240,23 @@ with tabs[1]:
             key="select_b_filtrado_tab"
         )
 
+    if grupo_elegido == "compartido":
+        # Disponibilidad del reactivo en todos los paneles (una sola consulta al índice)
+        resumen_comp = st.session_state["indice_compartidos"]["resumen"]
+        ref_comp = seleccion.split(" - ", 1)[0].strip()
+        if ref_comp in resumen_comp.index:
+            disp = resumen_comp.loc[ref_comp]
+            col_st, col_ped, col_pan = st.columns(3)
+            col_st.metric("Stock total (A)", int(disp["Stock total"]))
+            col_ped.metric("Pedidos pendientes", int(disp["Pedidos pendientes"]))
+            col_pan.metric("Nº paneles", int(disp["Nº paneles"]))
+            st.write(f"**Reparto por panel:** {disp['Reparto por panel']}")
+        else:
+            st.info("Este reactivo no figura en ninguna hoja de la base A.")
+
+        with st.expander("Reactivos compartidos entre varios paneles", expanded=False):
+            st.dataframe(resumen_comp[resumen_comp["Nº paneles"] > 1].sort_index())
+
     if st.button("Buscar en Base Historial", key="buscar_filtrado"):
         if grupo_elegido == "limitante":
             i_sel = [display_label_limit(x) for x in op_list].index(seleccion)
@@ -909,23 +2303,43 @@ with tabs[2]:
         st.error("No existe columna 'Nombre producto' en esta hoja A.")
         st.stop()
 
-    df_a["nombre_ref"] = df_a["Nombre producto"].astype(str) + " (" + df_a["Ref. Fisher"].astype(str) + ")"
-    nombre_ref_unicos = sorted(df_a["nombre_ref"].dropna().unique())
+    indice_busqueda = st.session_state["indice_busqueda"]
+    texto_agotado = st.text_input(
+        "Buscar reactivo (nombre, Ref. Fisher, Ref. Saturno o NºLote):", key="busqueda_agotado"
+    )
+    nombre_ref_unicos = opciones_reactivo(indice_busqueda, hoja_sel, texto_agotado, ordenadas=True)
+    if not nombre_ref_unicos:
+        st.warning("Ningún reactivo de esta hoja coincide con la búsqueda.")
+        nombre_ref_unicos = opciones_reactivo(indice_busqueda, hoja_sel, ordenadas=True)
     nombre_ref_sel = st.selectbox("Nombre producto en A (Ref. Fisher):", nombre_ref_unicos, key="agotado_nombre")
 
     nombre_sel = nombre_ref_sel.rsplit(" (", 1)[0].strip()
     ref_sel = nombre_ref_sel.rsplit(" (", 1)[1].replace(")", "").strip()
 
-    df_cand = df_a[
-        (df_a["Nombre producto"] == nombre_sel) &
-        (df_a["Ref. Fisher"] == ref_sel)
-    ]
+    idx_c = indice_busqueda["paneles"].get(hoja_sel, {}).get("fila_por_etiqueta", {}).get(nombre_ref_sel)
 
-    if df_cand.empty:
+    if idx_c is None or idx_c not in df_a.index:
         st.warning("No se encontró ese nombre en la hoja A.")
     else:
-        idx_c = df_cand.index[0]
         stock_c = df_a.at[idx_c, "Stock"] if "Stock" in df_a.columns else 0
+        # Sugerencia FEFO (First Expired, First Out) con los lotes de todos los paneles
+        df_fefo = sugerencia_fefo(st.session_state["indice_caducidad"], ref_sel)
+        if not df_fefo.empty:
+            primero = df_fefo.iloc[0]
+            st.info(
+                f"FEFO: usar primero el lote **{primero['NºLote']}** "
+                f"({primero['Panel']}, caduca {primero['Caducidad'].strftime('%d/%m/%Y')})."
+            )
+            with st.expander("Lotes disponibles ordenados por caducidad", expanded=False):
+                st.dataframe(df_fefo[["Panel", "NºLote", "Caducidad", "Stock"]], hide_index=True)
+        df_caducados = lotes_caducados_con_stock(st.session_state["indice_caducidad"], ref_sel)
+        if not df_caducados.empty:
+            st.warning(
+                "Lotes caducados con stock (no usar): "
+                + ", ".join(f"{r['NºLote']} ({r['Panel']}, caducó {r['Caducidad'].strftime('%d/%m/%Y')})"
+                            for _, r in df_caducados.iterrows())
+            )
+
         uds_consumir = st.number_input("Uds. a consumir en A:", min_value=0, step=1, key="agotado_uds")
         if st.button("Consumir en Lab (memoria)", key="agotado_consumir"):
             nuevo_stock = max(0, stock_c - uds_consumir)
@@ -939,21 +2353,14 @@ with tabs[2]:
                         else:
                             df_a.at[idx_c, col_vaciar] = ""
             st.session_state["data_dict"][hoja_sel] = df_a
+            notificar_cambio("A", hoja_sel, filas=[idx_c])
             st.warning(f"Consumidas {uds_consumir} uds. Stock final => {nuevo_stock}. (Sólo en memoria).")
 
     st.write("**Eliminar en B** => introduce el Lote exacto. Si coincide Nombre+Lote, se borra de B.")
     lote_b = st.text_input("Nº de Lote (en B)", value="", key="agotado_lote")
 
     if st.button("Guardar Cambios en Consumo Lab", key="agotado_guardar"):
-        # Guardar nueva versión en A
-        new_file_a = crear_nueva_version_filename(VERSIONS_DIR, prefix="StockA")
-        with pd.ExcelWriter(new_file_a, engine="openpyxl") as writer:
-            for sht, df_sht in st.session_state["data_dict"].items():
-                cols_int = ["ColorGroup","EsTitulo","GroupCount","MultiSort","NotTitulo","GroupID","Alarma","nombre_ref"]
-                temp = df_sht.drop(columns=cols_int, errors="ignore")
-                temp.to_excel(writer, sheet_name=sht, index=False)
-
-        st.success(f"✅ Cambios de consumo guardados en nueva versión A => {new_file_a}")
+        bases_guardar = ["A"]
 
         # Actualizar la base B si coincide
         if hoja_sel in st.session_state["data_dict_b"]:
@@ -965,13 +2372,294 @@ with tabs[2]:
                     (df_b_hoja["NºLote"] == lote_b)
                 )]
                 st.session_state["data_dict_b"][hoja_sel] = df_b_hoja
+                notificar_cambio("B", hoja_sel)
+                bases_guardar.append("B")
 
-                new_file_b = crear_nueva_version_filename(VERSIONS_DIR_B, prefix="StockB")
-                with pd.ExcelWriter(new_file_b, engine="openpyxl") as writer_b:
-                    for sht_b, df_sht_b in st.session_state["data_dict_b"].items():
-                        df_sht_b.to_excel(writer_b, sheet_name=sht_b, index=False)
+        try:
+            rutas = guardar_versiones(*bases_guardar)
+        except ValueError as e:
+            st.session_state["aviso_guardado"] = str(e)
+            st.rerun()
 
-                st.success(f"✅ Se eliminó la fila en B si coincidía. Nueva versión => {new_file_b}")
+        st.success(f"✅ Cambios de consumo guardados en nueva versión A => {rutas['A']}")
+        if "B" in rutas:
+            st.success(f"✅ Se eliminó la fila en B si coincidía. Nueva versión => {rutas['B']}")
 
         time.sleep(2)
         st.rerun()
+
+# ---------------------- TAB 4: Caducidades Próximas ----------------------
+with tabs[3]:
+    st.write("### Lotes que caducan próximamente (todos los paneles)")
+    dias_cad = st.number_input("Caducan en los próximos N días:", min_value=0, value=30, step=1, key="cad_dias")
+    incluir_caducados = st.checkbox("Incluir lotes ya caducados", value=True, key="cad_incluir")
+    incluir_historico = st.checkbox(
+        "Incluir lotes que sólo constan en el histórico (B) con stock", value=False, key="cad_historico"
+    )
+
+    df_cad = lotes_por_caducar(
+        st.session_state["indice_caducidad"], int(dias_cad), incluir_caducados, incluir_historico
+    )
+    if df_cad.empty:
+        st.success(f"Ningún lote caduca en los próximos {int(dias_cad)} días.")
+    else:
+        st.write(f"**{len(df_cad)} lotes** caducan en los próximos {int(dias_cad)} días.")
+        st.dataframe(
+            df_cad[["Días restantes", "Caducidad", "Panel", "Origen", "Nombre producto", "Ref. Fisher", "NºLote", "Stock"]],
+            hide_index=True
+        )
+
+        excel_cad = generar_excel_en_memoria(df_cad.drop(columns=["Fila"]), "Caducidades")
+        st.download_button(
+            label="Descargar caducidades en Excel",
+            data=excel_cad,
+            file_name="Caducidades_Proximas.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+# ---------------------- TAB 5: Alarmas de todos los paneles ----------------------
+with tabs[4]:
+    st.write("### ¿Qué hay que pedir? Alarmas de todos los paneles")
+    tabla_alarmas = st.session_state["tabla_alarmas"]
+    n_rojas = int((tabla_alarmas["Alarma"] == "🔴").sum())
+    n_amarillas = int((tabla_alarmas["Alarma"] == "🟨").sum())
+
+    col_rojo, col_amarillo = st.columns(2)
+    col_rojo.metric("🔴 Sin stock y sin pedir", n_rojas)
+    col_amarillo.metric("🟨 Sin stock, ya pedido", n_amarillas)
+
+    if tabla_alarmas.empty:
+        st.success("No hay reactivos con alarma en ningún panel.")
+    else:
+        filtro_alarma = st.radio(
+            "Mostrar:", ("Todas", "🔴", "🟨"), horizontal=True, key="alarmas_filtro"
+        )
+        vista_alarmas = tabla_alarmas.reset_index()
+        if filtro_alarma != "Todas":
+            vista_alarmas = vista_alarmas[vista_alarmas["Alarma"] == filtro_alarma]
+        vista_alarmas = vista_alarmas.sort_values(["Alarma", "Panel", "Nombre producto"], kind="mergesort")
+        st.dataframe(vista_alarmas.drop(columns=["Fila"]), hide_index=True)
+
+# ---------------------- TAB 6: Previsión de Consumo ----------------------
+with tabs[5]:
+    st.write("### Previsión de consumo y fecha de pedido (según historial B)")
+    if "prevision_consumo" not in st.session_state:
+        st.session_state["prevision_consumo"] = calcular_prevision(
+            st.session_state["estado_prevision"]["agregados"], st.session_state["indice_compartidos"]["resumen"]
+        )
+    df_prev = st.session_state["prevision_consumo"]
+
+    if df_prev.empty:
+        st.info("No hay suficiente historial en B para estimar el consumo.")
+    else:
+        horizonte = st.number_input(
+            "Mostrar reactivos a pedir en los próximos N días:", min_value=0, value=30, step=1, key="prev_dias"
+        )
+        limite = pd.Timestamp(datetime.date.today()) + pd.Timedelta(days=int(horizonte))
+        df_prev_vista = df_prev[df_prev["Fecha pedido sugerida"] <= limite]
+        st.write(f"**{len(df_prev_vista)} reactivos** deberían pedirse antes del {limite.strftime('%d/%m/%Y')}.")
+        st.dataframe(df_prev_vista, hide_index=True)
+
+        excel_prev = generar_excel_en_memoria(df_prev, "Prevision")
+        st.download_button(
+            label="Descargar previsión completa en Excel",
+            data=excel_prev,
+            file_name="Prevision_Consumo.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+# ---------------------- TAB 7: Auditoría de la Base B ----------------------
+with tabs[6]:
+    st.write("### Auditoría de cambios (Base B, todos los paneles)")
+    indice_aud = st.session_state["indice_auditoria"]
+    if indice_aud["registros"].empty:
+        st.info("No hay registros en la Base B.")
+    else:
+        col_usr, col_ref, col_lote = st.columns(3)
+        with col_usr:
+            usuarios = ["(Todos)"] + sorted(u for u in indice_aud["por_usuario"] if u)
+            usuario_aud = st.selectbox("Usuario:", usuarios, key="aud_usuario")
+        with col_ref:
+            ref_aud = st.text_input("Ref. Fisher (exacta):", key="aud_ref")
+        with col_lote:
+            lote_aud = st.text_input("NºLote (exacto):", key="aud_lote")
+
+        filtrar_fechas = st.checkbox("Filtrar por rango de fechas", key="aud_filtrar_fechas")
+        desde_aud = hasta_aud = None
+        if filtrar_fechas:
+            hoy_aud = datetime.date.today()
+            rango = st.date_input(
+                "Rango de fechas (Fecha Registro B):",
+                value=(hoy_aud - datetime.timedelta(days=30), hoy_aud),
+                key="aud_rango"
+            )
+            if isinstance(rango, (list, tuple)) and len(rango) == 2:
+                desde_aud = rango[0]
+                hasta_aud = rango[1] + datetime.timedelta(days=1)
+
+        posiciones = consultar_auditoria(
+            indice_aud,
+            desde=desde_aud,
+            hasta=hasta_aud,
+            usuario=None if usuario_aud == "(Todos)" else usuario_aud,
+            ref_fisher=ref_aud,
+            lote=lote_aud,
+        )[::-1]
+
+        total = len(posiciones)
+        if total == 0:
+            st.warning("No hay registros que cumplan los filtros.")
+        else:
+            col_tam, col_pag = st.columns(2)
+            with col_tam:
+                tam_pagina = st.selectbox("Registros por página:", [25, 50, 100, 250], index=1, key="aud_tam")
+            n_paginas = (total - 1) // tam_pagina + 1
+            with col_pag:
+                pagina = st.number_input("Página:", min_value=1, max_value=n_paginas, value=1, step=1, key="aud_pag")
+            pagina_pos = posiciones[(pagina - 1) * tam_pagina: pagina * tam_pagina]
+            st.write(f"**{total} registros** (página {pagina} de {n_paginas}, más recientes primero).")
+            df_aud = indice_aud["registros"].iloc[pagina_pos]
+            columnas_aud = COLS_AUDITORIA + [c for c in df_aud.columns if c not in COLS_AUDITORIA]
+            st.dataframe(df_aud[columnas_aud], hide_index=True)
+
+            # El Excel de todos los resultados sólo se genera a petición (puede ser todo el histórico)
+            clave_export = (desde_aud, hasta_aud, usuario_aud, ref_aud, lote_aud, total, len(indice_aud["registros"]))
+            export_aud = st.session_state.get("aud_export")
+            if export_aud is None or export_aud[0] != clave_export:
+                if st.button(f"Preparar Excel con los {total} registros", key="aud_preparar"):
+                    excel_aud = generar_excel_en_memoria(
+                        indice_aud["registros"].iloc[posiciones][columnas_aud], "Auditoria_B"
+                    )
+                    st.session_state["aud_export"] = export_aud = (clave_export, excel_aud)
+            if export_aud is not None and export_aud[0] == clave_export:
+                st.download_button(
+                    label="Descargar resultados de auditoría en Excel",
+                    data=export_aud[1],
+                    file_name="Auditoria_B.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+
+# ---------------------- TAB 8: Entrada Rápida (Escáner) ----------------------
+def registrar_escaneo():
+    """Callback del campo de escaneo: resuelve el código y lo añade a los pendientes."""
+    codigo = st.session_state.get("scan_codigo", "").strip()
+    st.session_state["scan_codigo"] = ""
+    if not codigo:
+        return
+    st.session_state.pop("scan_ambiguo", None)
+    st.session_state.pop("scan_destino", None)
+    panel = st.session_state.get("scan_panel", "Todos")
+    posiciones = resolver_codigo(
+        st.session_state["indice_busqueda"], codigo, None if panel == "Todos" else panel
+    )
+    movimiento = st.session_state.get("scan_movimiento", "Entrada")
+    uds = int(st.session_state.get("scan_uds", 1))
+    if not posiciones:
+        st.session_state["scan_mensaje"] = ("error", f"Código '{codigo}' no encontrado (NºLote / Ref. Fisher).")
+        return
+    if len(posiciones) > 1:
+        # Reactivos compartidos: el mismo lote figura en la hoja de cada panel; elige el usuario
+        st.session_state["scan_ambiguo"] = {
+            "Código": codigo, "Posiciones": posiciones, "Movimiento": movimiento, "Uds.": uds
+        }
+        return
+    anadir_pendiente(*posiciones[0], codigo, movimiento, uds)
+
+def anadir_pendiente(panel: str, fila, codigo: str, movimiento: str, uds: int):
+    """Añade un movimiento escaneado a los pendientes de guardar."""
+    df_panel = st.session_state["data_dict"][panel]
+    st.session_state["scan_pendientes"].append({
+        "Panel": panel,
+        "Fila": fila,
+        "Código": codigo,
+        "Reactivo": st.session_state["indice_busqueda"]["paneles"][panel]["etiqueta_por_fila"].get(fila, ""),
+        "NºLote": _columna_texto(df_panel, "NºLote").at[fila],
+        "Ref. Fisher": _columna_texto(df_panel, "Ref. Fisher").at[fila],
+        "Movimiento": movimiento,
+        "Uds.": uds,
+    })
+    st.session_state["scan_mensaje"] = ("success", f"Escaneado: {codigo} → {panel}")
+
+def elegir_destino_escaneo():
+    """Callback de 'Añadir': registra el código ambiguo en la fila elegida."""
+    ambiguo = st.session_state.pop("scan_ambiguo")
+    panel, fila = ambiguo["Posiciones"][st.session_state["scan_destino"]]
+    anadir_pendiente(panel, fila, ambiguo["Código"], ambiguo["Movimiento"], ambiguo["Uds."])
+
+with tabs[7]:
+    st.write("### Entrada rápida por escáner (NºLote / Ref. Fisher)")
+    st.write("Escanee el código o escríbalo y pulse Enter. Los movimientos se acumulan y se guardan juntos.")
+
+    col_mov, col_uds = st.columns(2)
+    with col_mov:
+        st.radio("Movimiento:", ("Entrada", "Consumo"), horizontal=True, key="scan_movimiento")
+    with col_uds:
+        st.number_input("Uds. por escaneo:", min_value=1, value=1, step=1, key="scan_uds")
+    st.selectbox(
+        "Panel:", ["Todos"] + list(st.session_state["data_dict"].keys()), key="scan_panel",
+        help="Con un panel elegido, los lotes compartidos se registran en ese panel sin preguntar."
+    )
+    st.text_input("Código escaneado:", key="scan_codigo", on_change=registrar_escaneo)
+
+    if "scan_mensaje" in st.session_state:
+        tipo_msg, texto_msg = st.session_state.pop("scan_mensaje")
+        getattr(st, tipo_msg)(texto_msg)
+
+    ambiguo = st.session_state.get("scan_ambiguo")
+    if ambiguo:
+        paneles_idx = st.session_state["indice_busqueda"]["paneles"]
+        destinos = [
+            f"{panel} — {paneles_idx.get(panel, {}).get('etiqueta_por_fila', {}).get(fila, '')}"
+            for panel, fila in ambiguo["Posiciones"]
+        ]
+        st.warning(f"El código '{ambiguo['Código']}' está en {len(destinos)} filas. Elija dónde registrarlo:")
+        st.radio("Destino:", range(len(destinos)), format_func=lambda i: destinos[i], key="scan_destino")
+        col_elegir, col_cancelar = st.columns(2)
+        with col_elegir:
+            st.button("Añadir", key="scan_elegir", on_click=elegir_destino_escaneo)
+        with col_cancelar:
+            if st.button("Cancelar", key="scan_cancelar"):
+                st.session_state.pop("scan_ambiguo", None)
+                st.rerun()
+
+    pendientes = st.session_state["scan_pendientes"]
+    if pendientes:
+        df_pend = pd.DataFrame(pendientes)
+        st.write(f"**{len(df_pend)} movimientos pendientes** en {df_pend['Panel'].nunique()} paneles.")
+        st.dataframe(df_pend.drop(columns=["Fila"]), hide_index=True)
+
+        col_guardar, col_descartar = st.columns(2)
+        with col_guardar:
+            if st.button("Guardar movimientos escaneados", key="scan_guardar"):
+                validos, descartados = reubicar_pendientes(pendientes)
+                aviso_descartados = (
+                    f" {len(descartados)} descartado(s): su lote ya no está en el panel "
+                    f"({', '.join(m['Código'] for m in descartados)})." if descartados else ""
+                )
+                if not validos:
+                    st.session_state["scan_pendientes"] = []
+                    st.session_state["scan_mensaje"] = ("error", "No se ha guardado nada." + aviso_descartados)
+                    st.rerun()
+                tocadas = aplicar_movimientos(validos)
+                for hoja_scan, filas_scan in tocadas.items():
+                    notificar_cambio("A", hoja_scan, filas=filas_scan)
+                    notificar_cambio("B", hoja_scan)
+                try:
+                    rutas = guardar_versiones("A", "B")
+                    st.session_state["scan_pendientes"] = []
+                    st.session_state["scan_mensaje"] = (
+                        "warning" if descartados else "success",
+                        f"✅ {len(validos)} movimientos guardados => {os.path.basename(rutas['A'])} / "
+                        f"{os.path.basename(rutas['B'])}." + aviso_descartados
+                    )
+                except ValueError as e:
+                    # Se conservan los pendientes: al volver a guardar se localizan por NºLote
+                    # y Ref. Fisher en la versión recargada
+                    st.session_state["scan_mensaje"] = ("error", str(e))
+                st.rerun()
+        with col_descartar:
+            if st.button("Descartar pendientes", key="scan_descartar"):
+                st.session_state["scan_pendientes"] = []
+                st.rerun()
+    else:
+        st.info("No hay movimientos pendientes.")